@@ -0,0 +1,389 @@
+'''This module measures how the database operations behind the menu perform on large catalogs.
+A seeded generator builds catalogs of any size with realistic data, where a few authors have
+written many of the books and most books only have a little stock. Every operation is then
+timed against each catalog and the throughput and p50/p99 latencies are written to a JSON file
+so that runs can be compared to spot regressions.
+
+    python bookstore_benchmark.py --sizes 10000 100000 1000000 --output bench_results.json
+
+With --stress it instead simulates several clerks sharing one database file, each on its own
+thread and pooled connection doing a mix of reads and writes, and reports the throughput and
+the time lost waiting on locks.
+
+With --check-plans it instead checks that each of the common composite searches in PLAN_CHECKS
+is answered through an index, printing every plan, and exits with status 1 if any of them would
+read the whole books table.
+'''
+#====Module Section====#
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from bookstore_connections import ConnectionPool
+from bookstore_repository import BookRepository
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_ITERATIONS = 200
+DEFAULT_SEED = 3001
+DEFAULT_CLERKS = 8
+WRITE_FRACTION = 0.3
+#the share of a clerk's operations that change a book in the stress test
+BUILD_CHUNK = 10000
+#books are inserted this many at a time when a catalog is built
+PLAN_CHECKS = [
+    {'title': 'glass road'},
+    {'author': 'tara'},
+    {'title': 'glass', 'author': 'tara'},
+    {'title': 'glass', 'qty_range': (0, 5)},
+    {'title': 'glass', 'order': 'qty', 'descending': True},
+    {'author': 'tara', 'qty_range': (None, 3), 'order': 'title'},
+    {'id_range': (1000, 2000)},
+    {'id_range': (1000, None), 'qty_range': (0, 0)},
+    {'qty_range': (0, 0)},
+    {'qty_range': (0, 3), 'order': 'id'},
+    {'qty_range': (10, None), 'order': 'title'},
+    {'id_range': (1000, 20000), 'order': 'title'},
+    {'id_range': (5000, None), 'order': 'qty', 'descending': True},
+    {'order': 'title'},
+    {'order': 'qty', 'descending': True},
+]
+#the composite searches clerks run most, each must be answered without reading every book
+PLAN_CHECK_SIZES = [20000]
+#the catalog sizes --check-plans builds unless --sizes is given
+
+FIRST_NAMES = ['Anna', 'Ben', 'Chloe', 'Daniel', 'Emma', 'Felix', 'Grace', 'Hugo', 'Iris', 'Jack',
+    'Kate', 'Liam', 'Maya', 'Noah', 'Olive', 'Paul', 'Quinn', 'Rosa', 'Sam', 'Tara', 'Uma',
+    'Victor', 'Wendy', 'Xavier', 'Yara', 'Zack']
+LAST_NAMES = ['Adams', 'Brooks', 'Carter', 'Dixon', 'Evans', 'Fisher', 'Green', 'Hughes', 'Irving',
+    'Jones', 'King', 'Lewis', 'Morgan', 'Nash', 'Owens', 'Price', 'Quill', 'Reed', 'Shaw',
+    'Turner', 'Underwood', 'Vaughn', 'Walsh', 'Young']
+TITLE_WORDS = ['Silent', 'River', 'Shadow', 'Garden', 'Winter', 'Empire', 'Glass', 'Night', 'Stone',
+    'Crown', 'Ocean', 'Fire', 'Forest', 'Tower', 'Dream', 'Storm', 'Light', 'Iron', 'Secret',
+    'Moon', 'House', 'Song', 'City', 'Road', 'Heart', 'Star', 'Wolf', 'Lost', 'Last', 'Golden']
+
+
+#====Catalog Section====#
+def generate_catalog(size, seed=DEFAULT_SEED):
+    '''This generator yields size books as (id, Title, Author, Qty) tuples. The same seed
+    always gives the same catalog. Authors are picked with a long tail so a few of them have
+    written a lot of the books, and stock is mostly small with about one book in twenty out
+    of stock'''
+    rng = random.Random(seed)
+    author_count = max(size // 8, 50)
+    authors = [f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {number}' for number in range(author_count)]
+    weights = [1 / rank for rank in range(1, author_count + 1)]
+    #the author at rank n is picked in proportion to 1/n, like real sales of prolific authors
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    for book_id in range(1, size + 1):
+        words = rng.sample(TITLE_WORDS, rng.randint(2, 4))
+        title = f"The {' '.join(words)} {book_id}"
+        #the id on the end keeps every title unique
+        author = rng.choices(authors, cum_weights=cumulative)[0]
+        if rng.random() < 0.05:
+            qty = 0
+        else:
+            qty = int(rng.expovariate(1 / 25)) + 1
+        yield (book_id, title, author, qty)
+
+def build_catalog(path, size, seed=DEFAULT_SEED):
+    '''This function creates a new database file at path holding a generated catalog.
+    Any file already at path is replaced'''
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    repo = BookRepository.open(path)
+    repo.db.execute('PRAGMA synchronous = OFF')
+    #the catalog can be rebuilt from the seed so building it does not need to be crash safe
+    chunk = []
+    for book in generate_catalog(size, seed):
+        chunk.append(book)
+        if len(chunk) >= BUILD_CHUNK:
+            repo.add_many(chunk)
+            chunk = []
+    if chunk != []:
+        repo.add_many(chunk)
+    repo.db.execute('PRAGMA synchronous = FULL')
+    return repo
+
+
+#====Operation Section====#
+class Workload:
+    '''This class holds the operations that are timed. Each one does what the matching menu
+    option does against the database. They take random ids from the catalog, which holds ids
+    1 to size, and the new books added and deleted are kept apart from the ones read'''
+
+    def __init__(self, repo, size, seed):
+        self.repo = repo
+        self.size = size
+        self.rng = random.Random(seed)
+        self.titles = []
+        self.authors = []
+        #some real titles and authors are sampled so the searches find books
+        for book_id in self.rng.sample(range(1, size + 1), min(size, 500)):
+            book = repo.get_by_id(book_id)
+            self.titles.append(book.Title)
+            self.authors.append(book.Author)
+        self.deletable = self.rng.sample(range(1, size + 1), min(size, 5000))
+        self.next_new = 0
+
+    def random_id(self):
+        return self.rng.randint(1, self.size)
+
+    def view_books(self):
+        #view_books shows the first page then moves on to the next page from the last id
+        page = self.repo.page(after_id=self.random_id())
+        if page != []:
+            self.repo.page(before_id=page[0].id)
+
+    def search_id(self):
+        self.repo.get_by_id(self.random_id())
+
+    def search_title(self):
+        words = self.rng.choice(self.titles).split()
+        self.repo.search(' '.join(words[1:3]), 'Title')
+
+    def search_author(self):
+        self.repo.search(self.rng.choice(self.authors), 'Author')
+
+    def search_qty(self):
+        self.repo.find_by_qty(self.rng.randint(0, 100))
+
+    def composite_search(self):
+        #an author's books with a little stock, the kind of narrowed search a clerk runs at the till
+        low = self.rng.randint(0, 20)
+        self.repo.composite_search(author=self.rng.choice(self.authors), qty_range=(low, low + 10), order='title')
+
+    def low_stock(self):
+        self.repo.low_stock_count(5)
+        self.repo.low_stock(5, 100)
+
+    def top_by_qty(self):
+        self.repo.top_by_qty(10)
+
+    def author_totals(self):
+        self.repo.author_totals(self.rng.choice(self.authors))
+
+    def add_book(self):
+        #add_book checks for a duplicate title before the insert
+        self.next_new += 1
+        title = f'Benchmark Title {self.next_new}'
+        if self.repo.find_by_title(title) is None:
+            self.repo.add(title, self.rng.choice(self.authors), self.rng.randint(0, 50))
+
+    def update_book_change(self):
+        self.repo.update(self.random_id(), qty=self.rng.randint(0, 50))
+
+    def stock_movement(self):
+        #a restock goes through the stock ledger as an atomic increment with its movement row
+        self.repo.adjust_stock(self.random_id(), self.rng.randint(1, 10), 'restock')
+
+    def delete_book(self):
+        if self.deletable != []:
+            self.repo.delete(self.deletable.pop())
+
+OPERATIONS = ['view_books', 'search_id', 'search_title', 'search_author', 'search_qty', 'composite_search',
+    'low_stock', 'top_by_qty', 'author_totals',
+    'add_book', 'update_book_change', 'stock_movement', 'delete_book']
+
+
+#====Timing Section====#
+def percentile(sorted_times, fraction):
+    #This uses the nearest rank method on a list that is already sorted
+    rank = math.ceil(fraction * len(sorted_times))
+    return sorted_times[max(rank, 1) - 1]
+
+def time_operation(operation, iterations):
+    '''This function runs operation the given number of times and returns its throughput in
+    operations per second with the p50 and p99 latency in milliseconds'''
+    times = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    times.sort()
+    return {
+        'iterations': iterations,
+        'throughput_ops': round(iterations / elapsed, 1) if elapsed > 0 else None,
+        'p50_ms': round(percentile(times, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(times, 0.99) * 1000, 4),
+    }
+
+def run_benchmark(sizes=DEFAULT_SIZES, iterations=DEFAULT_ITERATIONS, seed=DEFAULT_SEED, directory=None, operations=OPERATIONS):
+    '''This function builds a catalog of each size and times every operation against it.
+    It returns a report dictionary ready to be written out as JSON'''
+    report = {
+        'seed': seed,
+        'iterations': iterations,
+        'sqlite_version': sqlite3.sqlite_version,
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory(dir=directory) as work_directory:
+        for size in sizes:
+            path = os.path.join(work_directory, f'catalog_{size}.db')
+            start = time.perf_counter()
+            repo = build_catalog(path, size, seed)
+            build_seconds = time.perf_counter() - start
+            print(f"Built a catalog of {size} books in {build_seconds:.1f}s")
+            workload = Workload(repo, size, seed)
+            for name in operations:
+                result = time_operation(getattr(workload, name), iterations)
+                result.update({'size': size, 'operation': name})
+                report['results'].append(result)
+                print(f"  {name}: {result['throughput_ops']} ops/s, p50 {result['p50_ms']}ms, p99 {result['p99_ms']}ms")
+            repo.close()
+    return report
+
+#====Stress Section====#
+def stress_test(path, size, clerks=DEFAULT_CLERKS, iterations=DEFAULT_ITERATIONS, write_fraction=WRITE_FRACTION, seed=DEFAULT_SEED):
+    '''This function runs clerks threads against the catalog at path at the same time. Each one
+    does iterations operations, reading a book by id or author most of the time and otherwise
+    changing a book's stock or adding a book. It returns the throughput, the latencies and the
+    lock waits counted by the connection pool'''
+    pool = ConnectionPool(path)
+    times = []
+    errors = []
+    times_lock = threading.Lock()
+
+    def clerk(number):
+        rng = random.Random(seed + number)
+        clerk_times = []
+        for count in range(iterations):
+            if rng.random() < write_fraction:
+                if rng.random() < 0.8:
+                    book_id = rng.randint(1, size)
+                    qty = rng.randint(0, 50)
+                    work = lambda db: BookRepository(db).update(book_id, qty=qty)
+                else:
+                    title = f'Clerk {number} Title {count}'
+                    work = lambda db: BookRepository(db).add(title, 'Stress Author', 1)
+                write = True
+            else:
+                book_id = rng.randint(1, size)
+                work = lambda db: BookRepository(db).get_by_id(book_id)
+                write = False
+            start = time.perf_counter()
+            try:
+                pool.run(work, write)
+            except sqlite3.Error as error:
+                errors.append(str(error))
+            clerk_times.append(time.perf_counter() - start)
+        with times_lock:
+            times.extend(clerk_times)
+
+    threads = [threading.Thread(target=clerk, args=(number,)) for number in range(clerks)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    pool.close()
+    times.sort()
+    return {
+        'operation': 'stress',
+        'size': size,
+        'clerks': clerks,
+        'iterations': len(times),
+        'write_fraction': write_fraction,
+        'throughput_ops': round(len(times) / elapsed, 1),
+        'p50_ms': round(percentile(times, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(times, 0.99) * 1000, 4),
+        'lock_waits': pool.lock_waits,
+        'lock_wait_ms': round(pool.lock_wait_seconds * 1000, 4),
+        'errors': len(errors),
+    }
+
+def run_stress(sizes=DEFAULT_SIZES, clerks=DEFAULT_CLERKS, iterations=DEFAULT_ITERATIONS, seed=DEFAULT_SEED, directory=None, write_fraction=WRITE_FRACTION):
+    #This builds a catalog of each size and runs the stress test on it
+    report = {
+        'seed': seed,
+        'iterations': iterations,
+        'sqlite_version': sqlite3.sqlite_version,
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory(dir=directory) as work_directory:
+        for size in sizes:
+            path = os.path.join(work_directory, f'catalog_{size}.db')
+            build_catalog(path, size, seed).close()
+            result = stress_test(path, size, clerks, iterations, write_fraction, seed)
+            report['results'].append(result)
+            print(f"{size} books, {clerks} clerks: {result['throughput_ops']} ops/s, p99 {result['p99_ms']}ms, "
+                f"{result['lock_waits']} lock waits ({result['lock_wait_ms']}ms), {result['errors']} errors")
+    return report
+
+#====Plan Section====#
+def full_scans(plan, limited=False):
+    '''This returns the steps of a query plan that read the whole books table rather than
+    search it, a walk along all of one of its indexes included. When the query has a LIMIT
+    and nothing is sorted afterwards, a walk in the order asked for stops once it has
+    found enough books, so it is not counted. A full-text step is only a scan when it has
+    no MATCH, which shows as an M in its index string'''
+    ordered = limited and not any('ORDER BY' in step for step in plan)
+    return [step for step in plan if ((step == 'SCAN books' or step.startswith('SCAN books USING ')) and not ordered)
+        or (step.startswith('SCAN books_fts ') and ':M' not in step)]
+
+def check_plans(sizes=PLAN_CHECK_SIZES, seed=DEFAULT_SEED, directory=None, checks=PLAN_CHECKS):
+    '''This function builds a catalog of each size and returns the composite searches in checks
+    whose plan reads the whole books table, as (size, filters, plan) tuples. The planner is
+    checked both before and after ANALYZE, as a new shop has no statistics yet'''
+    failures = []
+    with tempfile.TemporaryDirectory(dir=directory) as work_directory:
+        for size in sizes:
+            path = os.path.join(work_directory, f'catalog_{size}.db')
+            repo = build_catalog(path, size, seed)
+            for analyzed in (False, True):
+                if analyzed:
+                    repo.db.execute('ANALYZE')
+                    repo.db.commit()
+                for filters in checks:
+                    plan = repo.composite_plan(**filters)
+                    failed = full_scans(plan, limited=True) != []
+                    #every composite search has a LIMIT
+                    if failed:
+                        failures.append((size, filters, plan))
+                    print(f"{size} books{', analyzed' if analyzed else ''}: {'FULL SCAN' if failed else 'ok'} "
+                        f"{filters}: {' | '.join(plan)}")
+            repo.close()
+    return failures
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bookstore database operations on generated catalogs.')
+    parser.add_argument('--sizes', type=int, nargs='+', help=f'catalog sizes to build, {DEFAULT_SIZES} by default')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='times each operation is run')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='seed for the generated catalogs')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS, help='operations to time')
+    parser.add_argument('--directory', help='where the catalog files are built, defaults to the temp directory')
+    parser.add_argument('--output', default='bench_results.json', help='the JSON report to write')
+    parser.add_argument('--stress', action='store_true', help='run the multi-clerk stress test instead')
+    parser.add_argument('--clerks', type=int, default=DEFAULT_CLERKS, help='clerks running at once in the stress test')
+    parser.add_argument('--write-fraction', type=float, default=WRITE_FRACTION, help='share of stress test operations that write')
+    parser.add_argument('--check-plans', action='store_true', help='check the common composite searches use an index instead')
+    options = parser.parse_args(arguments)
+    if options.check_plans:
+        failures = check_plans(options.sizes or PLAN_CHECK_SIZES, options.seed, options.directory)
+        print(f"{len(failures)} composite searches read the whole books table")
+        return 1 if failures != [] else 0
+    options.sizes = options.sizes or DEFAULT_SIZES
+    if options.stress:
+        report = run_stress(options.sizes, options.clerks, options.iterations, options.seed, options.directory, options.write_fraction)
+    else:
+        report = run_benchmark(options.sizes, options.iterations, options.seed, options.directory, options.operations)
+    with open(options.output, 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Results written to {options.output}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+'''This module keeps the stock of several shops in one database file per branch, so each
+branch writes to its own file and no branch waits on another's writes. A branch file is an
+ordinary bookstore database, so everything that works on ebookstore works on a branch with
+--database, or with --branch in the menu and the CLI.
+
+The BranchCatalog searches every branch at once. Each branch is searched on its own thread
+with its own pooled connection, and SQLite lets go of the GIL while it works, so the
+branches really are searched in parallel. It also adds up the stock of a title across
+every branch.
+
+    python bookstore_branches.py                          list the branches and their sizes
+    python bookstore_branches.py --search potter          search every branch
+    python bookstore_branches.py --totals "Mordew"        a title's stock in every branch
+'''
+#====Module Section====#
+import argparse
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from bookstore_connections import ConnectionPool
+from bookstore_repository import BookRepository
+from bookstore_search import SEARCH_LIMIT
+
+BRANCH_DIRECTORY = 'branches'
+BRANCH_SUFFIX = '.ebookstore'
+BRANCH_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+WORKERS = 8
+#the most branches searched at the same time
+
+BranchBook = namedtuple('BranchBook', ['branch', 'id', 'Title', 'Author', 'Qty'])
+TitleStock = namedtuple('TitleStock', ['Title', 'total', 'branches'])
+#branches maps each branch holding the title to its quantity there
+
+
+#====Function Section====#
+def branch_path(name, directory=BRANCH_DIRECTORY):
+    #This returns the database file of a branch, the name becomes part of the file name so it is checked first
+    if not BRANCH_NAME.match(name):
+        raise ValueError('a branch name can only have letters, digits, - and _')
+    return os.path.join(directory, name + BRANCH_SUFFIX)
+
+def branch_names(directory=BRANCH_DIRECTORY):
+    #This lists the branches that have a database file, in name order
+    if not os.path.isdir(directory):
+        return []
+    return sorted(file_name[:-len(BRANCH_SUFFIX)] for file_name in os.listdir(directory)
+        if file_name.endswith(BRANCH_SUFFIX))
+
+def branch_database(name, directory=BRANCH_DIRECTORY):
+    '''This function returns the database file to open for a branch, creating the directory
+    the first time a branch is used. Opening the file creates an empty branch database'''
+    path = branch_path(name, directory)
+    os.makedirs(directory, exist_ok=True)
+    return path
+
+def open_branch(name, directory=BRANCH_DIRECTORY, **options):
+    #This opens one branch's repository
+    return BookRepository.open(branch_database(name, directory), **options)
+
+
+#====Class Section====#
+class BranchCatalog:
+    '''This class answers questions about every branch at once. Each branch has its own
+    ConnectionPool, so the worker threads keep their connections open between searches.
+    Branches added to the directory after it was made are picked up by refresh()'''
+
+    def __init__(self, directory=BRANCH_DIRECTORY, workers=WORKERS):
+        self.directory = directory
+        self.pools = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bookstore-branch')
+        self.refresh()
+
+    def refresh(self):
+        for name in branch_names(self.directory):
+            if name not in self.pools:
+                self.pools[name] = ConnectionPool(branch_path(name, self.directory))
+
+    def branches(self):
+        return sorted(self.pools)
+
+    def fan_out(self, work):
+        '''This function runs work(repo) against every branch in parallel and returns a
+        dictionary of each branch's answer'''
+        futures = {name: self.executor.submit(pool.run, lambda db: work(BookRepository(db)))
+            for name, pool in self.pools.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def search(self, text, column=None, limit=SEARCH_LIMIT):
+        '''This function is the full-text search across every branch. Each branch's best
+        matches are kept in order and the branches are taken in turn, so the best match of
+        every branch comes before any branch's second best'''
+        results = self.fan_out(lambda repo: repo.search(text, column, limit))
+        merged = sorted((position, name, book) for name, books in results.items()
+            for position, book in enumerate(books))
+        return [BranchBook(name, *book) for position, name, book in merged[:limit]]
+
+    def get_by_id(self, book_id):
+        #Ids are only unique within a branch, so this can find a different book in each branch
+        results = self.fan_out(lambda repo: repo.get_by_id(book_id))
+        return [BranchBook(name, *book) for name, book in sorted(results.items()) if book is not None]
+
+    def title_stock(self, title):
+        '''This function adds up the stock of a title across every branch. The title is found
+        through each branch's unique index, and None is returned if no branch has it'''
+        results = self.fan_out(lambda repo: repo.find_by_title(title))
+        branches = {name: book.Qty for name, book in sorted(results.items()) if book is not None}
+        if branches == {}:
+            return None
+        return TitleStock(title, sum(branches.values()), branches)
+
+    def counts(self):
+        return self.fan_out(lambda repo: repo.count())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for pool in self.pools.values():
+            pool.close()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Search and total the stock of every branch.')
+    parser.add_argument('--directory', default=BRANCH_DIRECTORY, help='the directory holding the branch files')
+    parser.add_argument('--search', help='search every branch for this text')
+    parser.add_argument('--field', choices=('title', 'author'), help='only search this field')
+    parser.add_argument('--totals', metavar='TITLE', help="show this title's stock in every branch")
+    options = parser.parse_args(arguments)
+    catalog = BranchCatalog(options.directory)
+    try:
+        if catalog.branches() == []:
+            print(f"There are no branches in {options.directory}")
+        elif options.search is not None:
+            column = options.field.capitalize() if options.field else None
+            for book in catalog.search(options.search, column):
+                print(f"Branch: {book.branch}, ID: {book.id}, Title: {book.Title}, Author: {book.Author}, Quantity: {book.Qty}")
+        elif options.totals is not None:
+            stock = catalog.title_stock(options.totals)
+            if stock is None:
+                print("No branch has this title")
+            else:
+                for name, qty in stock.branches.items():
+                    print(f"Branch: {name}, Quantity: {qty}")
+                print(f"Total: {stock.total}")
+        else:
+            for name, count in sorted(catalog.counts().items()):
+                print(f"Branch: {name}, Books: {count}")
+    finally:
+        catalog.close()
+
+if __name__ == '__main__':
+    main()
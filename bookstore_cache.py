@@ -0,0 +1,191 @@
+'''This module keeps recently looked up books in memory so repeated lookups of the same hot
+titles and ids do not go back to the database each time. The cache holds a fixed number of
+entries, dropping the least recently used first, and entries can also expire after a time to
+live so changes made by other clerks' terminals are picked up. Changes made through the
+CachedBookRepository remove the entries they affect straight away.
+'''
+#====Module Section====#
+import threading
+import time
+from collections import OrderedDict
+
+from bookstore_receiving import RECEIVE_NOTE
+from bookstore_search import title_key
+
+CACHE_SIZE = 1024
+#the most lookups kept in memory
+CACHE_TTL = 30.0
+#seconds an entry is trusted for, None keeps entries until they are evicted
+
+
+#====Class Section====#
+class LRUCache:
+    '''This class is a least recently used cache that is safe to share between threads.
+    The hits, misses, evictions and expirations counters show how well it is sized'''
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.version = 0
+        #this goes up on every invalidation so a lookup that raced a write is not stored
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, load):
+        '''This function returns the cached value for key, or calls load to read it from the
+        database and keeps the result. None results are cached too, so asking again for a
+        missing id is also answered from memory'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored = entry
+                if self.ttl is None or self.clock() - stored < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            version = self.version
+        value = load()
+        with self._lock:
+            if version == self.version:
+                self._entries[key] = (value, self.clock())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class CachedBookRepository:
+    '''This class puts an LRUCache in front of a BookRepository. Lookups by id, exact title,
+    author and the full-text searches are read through the cache, and add, update and delete
+    remove every entry they could have changed. Search results are keyed on a write count
+    so any write makes all earlier searches stale, as a new or changed book could now match
+    any of them. Everything else is passed straight to the repository'''
+
+    def __init__(self, repo, cache=None):
+        self.repo = repo
+        self.cache = cache if cache is not None else LRUCache()
+
+    def __getattr__(self, name):
+        return getattr(self.repo, name)
+
+    #====Lookups====#
+    def get_by_id(self, book_id):
+        return self.cache.get_or_load(('id', book_id), lambda: self.repo.get_by_id(book_id))
+
+    def find_by_title(self, title):
+        #titles are cached by their title key, as every title with the same key finds the same book
+        return self.cache.get_or_load(('title', title_key(title)), lambda: self.repo.find_by_title(title))
+
+    def find_by_author(self, author):
+        #a tuple is cached so a caller changing the list it is given cannot change the cache
+        return list(self.cache.get_or_load(('author', author), lambda: tuple(self.repo.find_by_author(author))))
+
+    def search(self, text, column=None, limit=None):
+        arguments = (text, column) if limit is None else (text, column, limit)
+        key = ('search', self.cache.version, *arguments)
+        return list(self.cache.get_or_load(key, lambda: tuple(self.repo.search(*arguments))))
+
+    #====Writes====#
+    def _forget(self, *books):
+        #This removes the id, title and author entries of each book given
+        keys = []
+        for book in books:
+            if book is not None:
+                keys.extend((('id', book[0]), ('author', book[2])))
+                if book[1] is not None:
+                    keys.append(('title', title_key(book[1])))
+        self.cache.invalidate(*keys)
+
+    def add(self, title, author, qty, book_id=None, isbn=None, commit=True):
+        new_id = self.repo.add(title, author, qty, book_id, isbn, commit=commit)
+        self._forget((new_id, title, author, qty))
+        return new_id
+
+    def add_many(self, books, commit=True):
+        self.repo.add_many(books, commit=commit)
+        self.cache.clear()
+
+    def update(self, book_id, title=None, author=None, qty=None, isbn=None, commit=True):
+        old_book = self.repo.get_by_id(book_id)
+        #the book is read from the database, not the cache, so the old title and author are exact
+        updated = self.repo.update(book_id, title, author, qty, isbn, commit=commit)
+        if old_book is not None:
+            new_book = (book_id, title or old_book[1], author or old_book[2], qty)
+            self._forget(old_book, new_book)
+        return updated
+
+    def delete(self, book_id, commit=True):
+        old_book = self.repo.get_by_id(book_id)
+        deleted = self.repo.delete(book_id, commit=commit)
+        self._forget(old_book or (book_id, None, None, None))
+        return deleted
+
+    def adjust_stock(self, book_id, delta, kind, note=None, commit=True):
+        qty = self.repo.adjust_stock(book_id, delta, kind, note, commit=commit)
+        self._forget(self.repo.get_by_id(book_id))
+        return qty
+
+    def set_stock(self, book_id, qty, note=None, commit=True):
+        qty = self.repo.set_stock(book_id, qty, note, commit=commit)
+        self._forget(self.repo.get_by_id(book_id))
+        return qty
+
+    def rename_author(self, old_name, new_name, commit=True):
+        #Renaming an author changes every book and search of theirs, so the whole cache is emptied
+        books = self.repo.rename_author(old_name, new_name, commit=commit)
+        self.cache.clear()
+        return books
+
+    def receive(self, batch, note=RECEIVE_NOTE, commit=True):
+        #A delivery can change the stock of any number of books, so the whole cache is emptied
+        result = self.repo.receive(batch, note, commit=commit)
+        self.cache.clear()
+        return result
+
+    def import_books(self, path):
+        #An import adds books whose ids and titles may be cached as not found, so the whole cache is emptied
+        try:
+            return self.repo.import_books(path)
+        finally:
+            self.cache.clear()
+
+    def delete_where(self, *arguments, **filters):
+        #A batch delete could remove any book so the whole cache is emptied afterwards
+        deleted = self.repo.delete_where(*arguments, **filters)
+        if not filters.get('dry_run'):
+            self.cache.clear()
+        return deleted
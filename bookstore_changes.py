@@ -0,0 +1,156 @@
+'''This module reads the change log that triggers write for every book added, changed or
+deleted (see bookstore_schema). A mirror of the catalog, like the website or the warehouse,
+asks for the changes after the last seq it has seen, so keeping up costs as much as the number
+of changes and not the size of the catalog.
+
+Each change comes with the book as it is now, or no book once it has been deleted, so a mirror
+applying the changes in order ends up with the books as they are. A mirror can record how far
+it has read under its own name, and the changes every mirror has read can then be pruned. A
+mirror asking for changes that have been pruned gets a ChangeLogError, and must read every
+book again and carry on from latest_change().
+
+    python bookstore_changes.py --since 120          every change after seq 120, as JSON lines
+    python bookstore_changes.py --consumer website   the changes website has not read, which are then marked read
+    python bookstore_changes.py --prune              delete the changes every consumer has read
+'''
+#====Module Section====#
+import argparse
+import json
+import sys
+from collections import namedtuple
+
+from bookstore_connections import DATABASE_PATH, open_connection
+
+CHANGE_LIMIT = 1000
+#the most changes read in one query
+
+Change = namedtuple('Change', ['seq', 'operation', 'id', 'Title', 'Author', 'Qty', 'changed_at'])
+#Title, Author and Qty are the book as it is now, they are None for a delete
+
+
+class ChangeLogError(ValueError):
+    #This is raised when some of the changes asked for have already been pruned
+    pass
+
+
+#====Function Section====#
+def latest_change(db):
+    #This returns the seq of the newest change, or 0 if there has not been one, even once every change is pruned
+    row = db.execute('''
+    SELECT seq FROM sqlite_sequence WHERE name = 'book_changes'
+    ''').fetchone()
+    return 0 if row is None else row[0]
+
+def pruned_through(db):
+    #Every change up to and including this seq has been pruned, seqs have no gaps so the oldest kept tells us
+    oldest = db.execute('''
+    SELECT MIN(seq) FROM book_changes
+    ''').fetchone()[0]
+    return latest_change(db) if oldest is None else oldest - 1
+
+def changes_since(db, seq, limit=CHANGE_LIMIT):
+    '''This function returns up to limit changes after seq, oldest first. The changes are
+    read along the seq primary key and each book is found by its id, so this costs the same
+    however large the catalog is. Both are read in one transaction so a prune cannot happen
+    in between. ChangeLogError is raised if any change after seq has been pruned'''
+    started = not db.in_transaction
+    if started:
+        db.execute('BEGIN')
+    try:
+        pruned = pruned_through(db)
+        if seq < pruned:
+            raise ChangeLogError(f'the changes up to {pruned} have been pruned, read every book again '
+                f'and carry on from {latest_change(db)}')
+        return [Change._make(row) for row in db.execute('''
+        SELECT book_changes.seq, book_changes.operation, book_changes.book_id, books.Title, authors.Name,
+            books.Qty, book_changes.changed_at
+        FROM book_changes
+        LEFT JOIN books ON books.id = book_changes.book_id AND book_changes.operation != 'delete'
+        LEFT JOIN authors ON authors.id = books.author_id
+        WHERE book_changes.seq > ? ORDER BY book_changes.seq LIMIT ?
+        ''', (seq, limit))]
+        #a deleted book's id can be given to a new book later, so a delete is never joined to a book
+    finally:
+        if started:
+            db.commit()
+
+def stream_changes(db, seq, limit=CHANGE_LIMIT):
+    #This generator yields every change after seq, reading limit at a time so a long log is never all in memory
+    while True:
+        changes = changes_since(db, seq, limit)
+        yield from changes
+        if len(changes) < limit:
+            return
+        seq = changes[-1].seq
+
+def consumer_position(db, name):
+    #This returns the last seq the consumer marked as read, or None for a consumer not seen before
+    row = db.execute('''
+    SELECT seq FROM change_consumers WHERE name = ?
+    ''', (name,)).fetchone()
+    return None if row is None else row[0]
+
+def acknowledge(db, name, seq, commit=True):
+    #This records that the consumer has applied every change up to seq
+    db.execute('''
+    INSERT INTO change_consumers(name, seq) VALUES(?,?)
+    ON CONFLICT(name) DO UPDATE SET seq = excluded.seq, updated_at = CURRENT_TIMESTAMP
+    ''', (name, seq))
+    if commit:
+        db.commit()
+
+def forget_consumer(db, name, commit=True):
+    #A consumer that will never read again has to be forgotten, or the log can never be pruned past it
+    forgotten = db.execute('''
+    DELETE FROM change_consumers WHERE name = ?
+    ''', (name,)).rowcount > 0
+    if commit:
+        db.commit()
+    return forgotten
+
+def prune_changes(db, commit=True):
+    '''This function deletes the changes that every consumer has read and returns how many
+    it deleted. Nothing is pruned until at least one consumer has marked its place'''
+    pruned = db.execute('''
+    DELETE FROM book_changes WHERE seq <= (SELECT MIN(seq) FROM change_consumers)
+    ''').rowcount
+    if commit:
+        db.commit()
+    return pruned
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Read and prune the log of changes to the books.')
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--since', type=int, help='print every change after this seq')
+    parser.add_argument('--consumer', help='print the changes this consumer has not read, then mark them read')
+    parser.add_argument('--limit', type=int, default=CHANGE_LIMIT, help='changes read in each query')
+    parser.add_argument('--prune', action='store_true', help='delete the changes every consumer has read')
+    parser.add_argument('--forget', metavar='CONSUMER', help='stop keeping changes for this consumer')
+    options = parser.parse_args(arguments)
+    db = open_connection(options.database)
+    try:
+        if options.forget is not None:
+            if not forget_consumer(db, options.forget):
+                sys.stderr.write(f'there is no consumer called {options.forget}\n')
+                return 1
+        if options.since is not None or options.consumer is not None:
+            seq = options.since
+            if seq is None:
+                seq = consumer_position(db, options.consumer) or 0
+            try:
+                for change in stream_changes(db, seq, options.limit):
+                    sys.stdout.write(json.dumps(change._asdict()) + '\n')
+                    seq = change.seq
+            except ChangeLogError as error:
+                sys.stderr.write(f'error: {error}\n')
+                return 1
+            if options.consumer is not None:
+                acknowledge(db, options.consumer, seq)
+        if options.prune:
+            sys.stderr.write(f'{prune_changes(db)} changes pruned\n')
+    finally:
+        db.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+'''This program runs single bookstore commands from the command line or a script, without
+the menu. Only the modules a command needs are imported and the database is opened when the
+command runs, so a lookup does not pay for the menu's setup and takes milliseconds. Books are printed one per line as
+id, title, author and quantity separated by tabs, or as JSON lines with --json.
+
+    python -m bookstore_cli view --after 3010 --limit 5
+    python -m bookstore_cli search potter --field title
+    python -m bookstore_cli search --id 3001
+    python -m bookstore_cli search --isbn 978-0-261-10357-3
+    python -m bookstore_cli search "The Hobit" --similar
+    python -m bookstore_cli find --author tolkien --max-qty 3 --order title
+    python -m bookstore_cli add "Dune" "Frank Herbert" 12
+    python -m bookstore_cli update 3001 --qty 28
+    python -m bookstore_cli delete "3001, 3004-3010" --dry-run
+    python -m bookstore_cli rename-author "J.K. Rowling" "J. K. Rowling"
+    python -m bookstore_cli receive scans.txt
+    python -m bookstore_cli import delivery.csv
+    python -m bookstore_cli export catalog.jsonl
+    python -m bookstore_cli batch < commands.txt
+
+Batch mode reads one command per line from stdin, written the same way as on the command
+line, and runs them all over one connection. Blank lines and lines starting with # are
+skipped. A command that fails is reported with its line number and the rest still run.
+The exit status is 1 if any command failed.
+
+With --instrument every statement is timed and a summary is written to stderr at the end,
+each command in a batch being one operation. Slow statements go to the slow query log.
+'''
+#====Module Section====#
+import argparse
+import atexit
+import json
+import shlex
+import sqlite3
+import sys
+from contextlib import nullcontext
+
+from bookstore_connections import DATABASE_PATH, GROUP_MAX_WRITES, GROUP_MAX_DELAY
+from bookstore_repository import BookRepository, PAGE_SIZE, SEARCH_ORDERS, id_selection
+from bookstore_ledger import StockError
+from bookstore_search import SEARCH_LIMIT
+
+FIELDS = ('title', 'author')
+
+
+class CommandError(Exception):
+    #This is raised for a command that cannot be run, the message is shown to the user
+    pass
+
+
+#====Function Section====#
+def show(books, as_json, output=sys.stdout):
+    #This prints each book on its own line
+    for book in books:
+        if as_json:
+            output.write(json.dumps(book._asdict()) + '\n')
+        else:
+            output.write(f'{book[0]}\t{book[1]}\t{book[2]}\t{book[3]}\n')
+
+def message(text, as_json, output=sys.stdout, **values):
+    #This prints the result of a command that changes books, as a sentence or as one JSON object
+    if as_json:
+        output.write(json.dumps(values) + '\n')
+    else:
+        output.write(text + '\n')
+
+def view(repo, options):
+    if options.all:
+        show(repo.all_books(), options.json)
+    else:
+        show(repo.page(after_id=options.after, limit=options.limit), options.json)
+
+def search(repo, options):
+    if options.id is not None:
+        book = repo.get_by_id(options.id)
+        show([book] if book is not None else [], options.json)
+    elif options.isbn is not None:
+        book = repo.find_by_isbn(options.isbn)
+        show([book] if book is not None else [], options.json)
+    elif options.qty is not None:
+        show(repo.find_by_qty(options.qty), options.json)
+    elif options.similar:
+        if not options.text:
+            raise CommandError('give the title to find nearly the same titles for')
+        show(repo.similar_titles(options.text, options.limit), options.json)
+    elif options.text:
+        column = options.field.capitalize() if options.field else None
+        show(repo.search(options.text, column, options.limit), options.json)
+    else:
+        raise CommandError('give the text to search for, --id or --qty')
+
+def find(repo, options):
+    #Every filter given has to match, the range ends can be given on their own
+    try:
+        arguments = (options.title, options.author, (options.min_id, options.max_id), (options.min_qty, options.max_qty),
+            options.order, options.desc, options.limit)
+        if options.plan:
+            sys.stdout.write('\n'.join(repo.composite_plan(*arguments)) + '\n')
+        else:
+            show(repo.composite_search(*arguments), options.json)
+    except ValueError as error:
+        raise CommandError(str(error))
+
+def add(repo, options):
+    if options.qty < 0:
+        raise CommandError('the quantity cannot be negative')
+    new_id = repo.add(options.title, options.author, options.qty, options.id, options.isbn)
+    message(f'{new_id}', options.json, id=new_id)
+
+def update(repo, options):
+    if options.title is None and options.author is None and options.qty is None and options.isbn is None:
+        raise CommandError('give --title, --author, --qty or --isbn to change')
+    if not repo.update(options.id, options.title, options.author, options.qty, options.isbn):
+        raise CommandError(f'there is no book with the id {options.id}')
+    show([repo.get_by_id(options.id)], options.json)
+
+def delete(repo, options):
+    if options.out_of_stock:
+        book_filter = {'qty': 0}
+    elif options.ids is not None:
+        ids, id_ranges = id_selection(options.ids)
+        if ids is None:
+            raise CommandError('give IDs as numbers, for example "3001, 3004, 3006-3010"')
+        book_filter = {'ids': ids, 'id_ranges': id_ranges}
+    else:
+        raise CommandError('give the IDs to delete or --out-of-stock')
+    deleted = repo.delete_where(dry_run=options.dry_run, **book_filter)
+    if options.dry_run:
+        message(f'{deleted} books would be deleted', options.json, matched=deleted)
+    else:
+        message(f'{deleted} books deleted', options.json, deleted=deleted)
+
+def rename_author(repo, options):
+    books = repo.rename_author(options.old_name, options.new_name)
+    if books == 0:
+        raise CommandError(f'there is no author called {options.old_name}')
+    message(f'{books} books now have the author {options.new_name}', options.json, renamed=books)
+
+def receive_books(repo, options):
+    from bookstore_receiving import ScanBatch
+    batch = ScanBatch()
+    try:
+        if options.path == '-':
+            rejects = batch.read(sys.stdin)
+        else:
+            with open(options.path, newline='', encoding='utf-8') as scan_file:
+                rejects = batch.read(scan_file)
+    except OSError as error:
+        raise CommandError(f'the scans could not be read: {error}')
+    for line_number, reason in rejects:
+        sys.stderr.write(f'line {line_number} was not read: {reason}\n')
+    result = repo.receive(batch)
+    for isbn in result.unknown:
+        sys.stderr.write(f'{isbn} is not in the catalog, give its title and author in the scan file\n')
+    for isbn, reason in result.rejected:
+        sys.stderr.write(f'{isbn} was not added: {reason}\n')
+    message(f'{result.units} books received, {result.restocked} titles restocked and {result.added} added',
+        options.json, received=result.units, restocked=result.restocked, added=result.added,
+        unknown=result.unknown, rejected=len(rejects) + len(result.rejected))
+
+def import_books(repo, options):
+    try:
+        result = repo.import_books(options.path)
+    except (OSError, ValueError) as error:
+        raise CommandError(f'the file could not be imported: {error}')
+    for line_number, reason in result.rejects:
+        sys.stderr.write(f'line {line_number} was not imported: {reason}\n')
+    message(f'{result.inserted} books imported, {len(result.rejects)} rows rejected', options.json,
+        inserted=result.inserted, rejected=len(result.rejects))
+
+def export_books(repo, options):
+    from bookstore_transfer import export_file
+    repo.flush()
+    try:
+        written = export_file(repo.db, options.path)
+    except (OSError, ValueError) as error:
+        raise CommandError(f'the books could not be exported: {error}')
+    message(f'{written} books exported to {options.path}', options.json, exported=written)
+
+def batch(repo, options, lines=None, instruments=None):
+    '''This function runs every command read from lines, stdin by default, over one
+    repository. It returns the number of commands that failed'''
+    parser = build_parser(batch=True)
+    if options.group_commit:
+        repo.start_group_commit(options.group_size, options.group_delay)
+    failed = 0
+    for line_number, line in enumerate(sys.stdin if lines is None else lines, start=1):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            command = parser.parse_args(shlex.split(line))
+            command.json = command.json or options.json
+            run(repo, command, instruments)
+        except SystemExit:
+            #argparse has already printed why the line could not be read
+            failed += 1
+            sys.stderr.write(f'line {line_number} was not run\n')
+        except (CommandError, StockError, sqlite3.Error, ValueError) as error:
+            failed += 1
+            sys.stderr.write(f'line {line_number}: {error}\n')
+    repo.flush()
+    return failed
+
+COMMANDS = {
+    'view': view,
+    'search': search,
+    'find': find,
+    'add': add,
+    'update': update,
+    'delete': delete,
+    'rename-author': rename_author,
+    'receive': receive_books,
+    'import': import_books,
+    'export': export_books,
+}
+
+def run(repo, options, instruments=None):
+    #This runs one parsed command and returns the number of failures, which is 0 unless it was a batch
+    if options.command == 'batch':
+        return batch(repo, options, instruments=instruments)
+    with instruments.operation(options.command) if instruments is not None else nullcontext():
+        COMMANDS[options.command](repo, options)
+    return 0
+
+def build_parser(batch=False):
+    '''This function builds the argument parser. Inside a batch the --database option and the
+    batch command itself are left out, as the batch already has its connection'''
+    parser = argparse.ArgumentParser(prog='bookstore_cli', description='Run bookstore commands without the menu.')
+    if not batch:
+        parser.add_argument('--database', default=DATABASE_PATH)
+        parser.add_argument('--branch', help='use this branch\'s database file instead')
+        parser.add_argument('--branches', help='the directory holding the branch files, branches by default')
+        parser.add_argument('--instrument', action='store_true', help='time every statement and write a summary to stderr')
+        parser.add_argument('--slow-ms', type=float, help='statements slower than this are logged with their plan, 100 by default')
+        parser.add_argument('--slow-log', help='the file slow statements are written to, empty for none, slow_queries.log by default')
+        #the defaults are filled in by main() so bookstore_branches and bookstore_instrument are only imported when used
+    parser.add_argument('--json', action='store_true', help='print JSON lines instead of tab separated fields')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', action='store_true', default=argparse.SUPPRESS)
+    #--json can also be given after the command, where it only replaces the default if it is there
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('view', parents=[common], help='list books in id order, one page at a time')
+    command.add_argument('--after', type=int, help='start after this id')
+    command.add_argument('--limit', type=int, default=PAGE_SIZE)
+    command.add_argument('--all', action='store_true', help='list every book')
+
+    command = commands.add_parser('search', parents=[common], help='find books by title or author text, id or quantity')
+    command.add_argument('text', nargs='?')
+    command.add_argument('--field', choices=FIELDS, help='only search this field')
+    command.add_argument('--limit', type=int, default=SEARCH_LIMIT)
+    command.add_argument('--id', type=int)
+    command.add_argument('--isbn')
+    command.add_argument('--qty', type=int)
+    command.add_argument('--similar', action='store_true', help='find titles nearly the same as the text')
+
+    command = commands.add_parser('find', parents=[common], help='find books matching several filters at once')
+    command.add_argument('--title', help='words in the title')
+    command.add_argument('--author', help='words in the author\'s name')
+    command.add_argument('--min-id', type=int)
+    command.add_argument('--max-id', type=int)
+    command.add_argument('--min-qty', type=int)
+    command.add_argument('--max-qty', type=int)
+    command.add_argument('--order', choices=SEARCH_ORDERS, help='defaults to relevance with words and id without')
+    command.add_argument('--desc', action='store_true', help='reverse the order')
+    command.add_argument('--limit', type=int, default=SEARCH_LIMIT)
+    command.add_argument('--plan', action='store_true', help='print the query plan instead of the books')
+
+    command = commands.add_parser('add', parents=[common], help='add a new book and print its id')
+    command.add_argument('title')
+    command.add_argument('author')
+    command.add_argument('qty', type=int)
+    command.add_argument('--id', type=int)
+    command.add_argument('--isbn')
+
+    command = commands.add_parser('update', parents=[common], help="change a book's title, author or counted quantity")
+    command.add_argument('id', type=int)
+    command.add_argument('--title')
+    command.add_argument('--author')
+    command.add_argument('--qty', type=int)
+    command.add_argument('--isbn')
+
+    command = commands.add_parser('delete', parents=[common], help='delete books by IDs and ID ranges, or every out of stock book')
+    command.add_argument('ids', nargs='?', help='for example "3001, 3004, 3006-3010"')
+    command.add_argument('--out-of-stock', action='store_true')
+    command.add_argument('--dry-run', action='store_true', help='only count the books that would be deleted')
+
+    command = commands.add_parser('rename-author', parents=[common], help='rename an author on all of their books at once')
+    command.add_argument('old_name')
+    command.add_argument('new_name')
+
+    command = commands.add_parser('receive', parents=[common], help='receive a delivery from a file of scanned ISBNs')
+    command.add_argument('path', help='the scan file, or - to read the scans from stdin')
+
+    command = commands.add_parser('import', parents=[common], help='import books from a .csv or .jsonl file')
+    command.add_argument('path')
+
+    command = commands.add_parser('export', parents=[common], help='export every book to a .csv or .jsonl file')
+    command.add_argument('path')
+
+    if not batch:
+        command = commands.add_parser('batch', parents=[common], help='run one command per line from stdin over one connection')
+        command.add_argument('--group-commit', action='store_true', help='commit the writes together in groups')
+        command.add_argument('--group-size', type=int, default=GROUP_MAX_WRITES)
+        command.add_argument('--group-delay', type=float, default=GROUP_MAX_DELAY)
+    return parser
+
+def main(arguments=None):
+    parser = build_parser()
+    options = parser.parse_args(arguments)
+    path = options.database
+    if options.branch is not None:
+        from bookstore_branches import BRANCH_DIRECTORY, branch_database
+        try:
+            path = branch_database(options.branch, options.branches or BRANCH_DIRECTORY)
+        except ValueError as error:
+            parser.error(str(error))
+    group_commit = getattr(options, 'group_commit', False)
+    repo = BookRepository.open(path, check_same_thread=not group_commit)
+    #in group commit mode the writes are also committed from the group's timer thread
+    instruments = None
+    if options.instrument:
+        from bookstore_instrument import Instrumentation, SLOW_QUERY_MS, SLOW_QUERY_LOG
+        instruments = Instrumentation(SLOW_QUERY_MS if options.slow_ms is None else options.slow_ms,
+            SLOW_QUERY_LOG if options.slow_log is None else options.slow_log)
+        instruments.attach(repo.db)
+        atexit.register(lambda: sys.stderr.write(instruments.summary() + '\n'))
+    try:
+        failed = run(repo, options, instruments)
+    except (CommandError, StockError, sqlite3.Error, ValueError) as error:
+        sys.stderr.write(f'error: {error}\n')
+        failed = 1
+    finally:
+        if instruments is not None:
+            instruments.detach(repo.db)
+        repo.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+'''This module manages the connections to the database file when several clerks use it at once.
+Connections are opened in WAL mode so readers are never blocked by a writer, and with a busy
+timeout so a clerk waits for another clerk's write to finish instead of getting
+"database is locked". The ConnectionPool hands each thread its own connection and retries a
+piece of work with a backoff if the database stays busy.
+'''
+#====Module Section====#
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from bookstore_schema import migrate
+
+DATABASE_PATH = 'ebookstore'
+STATEMENT_CACHE_SIZE = 256
+#sqlite3 only keeps 128 compiled statements by default
+BUSY_TIMEOUT = 5.0
+#seconds SQLite itself waits for a lock before giving up
+RETRIES = 5
+BACKOFF = 0.05
+#seconds before the first retry, it doubles on each retry after that
+MAX_IDLE = 8
+#the most unused connections the pool keeps open for the next thread
+GROUP_MAX_WRITES = 500
+GROUP_MAX_DELAY = 1.0
+#in group commit mode writes are committed together once there are this many or this many seconds have passed
+MMAP_SIZE = None
+#bytes of the file read through memory mapping, None leaves SQLite's default of none
+CACHE_KIB = None
+#KiB of page cache for each connection, None leaves SQLite's default of about 2MB
+DURABILITY_LEVELS = ('FULL', 'NORMAL', 'OFF')
+#FULL syncs every commit to disk, NORMAL can lose the last commits on a power cut but never
+#corrupts the file in WAL mode, OFF leaves syncing to the operating system
+
+
+#====Function Section====#
+def open_connection(path=DATABASE_PATH, busy_timeout=BUSY_TIMEOUT, mmap_size=MMAP_SIZE, cache_kib=CACHE_KIB, **options):
+    '''This function opens a connection set up for sharing the file. WAL mode is stored in
+    the database file so it only really changes the first time, the busy timeout is set on
+    every connection. mmap_size and cache_kib let a large catalog be read through memory
+    mapping and a bigger page cache. The schema is brought up to date before the connection
+    is returned'''
+    options.setdefault('cached_statements', STATEMENT_CACHE_SIZE)
+    db = sqlite3.connect(path, timeout=busy_timeout, **options)
+    db.execute(f'PRAGMA busy_timeout = {int(busy_timeout * 1000)}')
+    if mmap_size is not None:
+        db.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+    if cache_kib is not None:
+        db.execute(f'PRAGMA cache_size = {-int(cache_kib)}')
+        #a negative cache size is in KiB rather than pages
+    db.execute('PRAGMA journal_mode = WAL')
+    migrate(db)
+    return db
+
+def is_busy_error(error):
+    #SQLite reports both a locked database and a busy one as an OperationalError
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+#====Class Section====#
+class ConnectionPool:
+    '''This class shares connections to one database file between threads.
+    A thread borrows a connection with the connection() context manager and gives it back at
+    the end, nested borrows on the same thread get the same connection. Connections are only
+    ever used by one thread at a time, so an idle one can be handed on to the next thread.
+    The time spent waiting on locks is added up in lock_wait_seconds and the number of
+    retries after the database stayed busy in lock_waits'''
+
+    def __init__(self, path=DATABASE_PATH, busy_timeout=BUSY_TIMEOUT, retries=RETRIES, backoff=BACKOFF, max_idle=MAX_IDLE):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self._idle = []
+        self._open = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle != []:
+                return self._idle.pop()
+        db = open_connection(self.path, self.busy_timeout, check_same_thread=False)
+        with self._lock:
+            self._open.append(db)
+        return db
+
+    def _checkin(self, db):
+        if db.in_transaction:
+            db.rollback()
+            #an unfinished transaction must never be handed on to another thread
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(db)
+                return
+            self._open.remove(db)
+        db.close()
+
+    @contextmanager
+    def connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            yield db
+            return
+        db = self._checkout()
+        self._local.db = db
+        try:
+            yield db
+        finally:
+            self._local.db = None
+            self._checkin(db)
+
+    def run(self, work, write=False):
+        '''This function calls work with this thread's connection and returns what it returns.
+        For writes the write lock is taken first with BEGIN IMMEDIATE, so the wait for
+        another clerk's write happens there under the busy timeout and is counted as lock
+        wait time. If the database is still busy the transaction is rolled back and work is
+        tried again after a growing, slightly random delay, so clerks that collided do not
+        all retry at the same moment'''
+        with self.connection() as db:
+            delay = self.backoff
+            for attempt in range(self.retries + 1):
+                start = time.perf_counter()
+                try:
+                    if write:
+                        db.execute('BEGIN IMMEDIATE')
+                        self._waited(time.perf_counter() - start)
+                    return work(db)
+                except sqlite3.OperationalError as error:
+                    if not is_busy_error(error) or attempt == self.retries:
+                        raise
+                    if db.in_transaction:
+                        db.rollback()
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+                    delay *= 2
+                    self._waited(time.perf_counter() - start, retried=True)
+                finally:
+                    if write and db.in_transaction:
+                        db.rollback()
+                        #work that did not commit its own changes has failed part way
+
+    def _waited(self, seconds, retried=False):
+        with self._lock:
+            self.lock_wait_seconds += seconds
+            if retried:
+                self.lock_waits += 1
+
+    def close(self):
+        #This closes every connection the pool has opened, none of them should still be in use
+        with self._lock:
+            for db in self._open:
+                db.close()
+            self._open = []
+            self._idle = []
+
+
+class GroupCommit:
+    '''This class commits many writes on one connection in a single transaction.
+    Each write is left uncommitted and counted, and they are all committed together once
+    max_writes have been made or max_delay seconds have passed since the first of them,
+    so receiving a delivery costs one sync to disk rather than one per book. Reads on the
+    same connection see the waiting writes straight away. Writes not yet flushed are lost if
+    the program is killed, so flush() must be called before exiting. synchronous sets the
+    durability level, one of DURABILITY_LEVELS, and None leaves it as it is'''
+
+    def __init__(self, db, max_writes=GROUP_MAX_WRITES, max_delay=GROUP_MAX_DELAY, synchronous=None):
+        self.db = db
+        self.max_writes = max_writes
+        self.max_delay = max_delay
+        self.pending = 0
+        self.flushes = 0
+        self.lock = threading.RLock()
+        self._timer = None
+        if synchronous is not None:
+            synchronous = synchronous.upper()
+            if synchronous not in DURABILITY_LEVELS:
+                raise ValueError(f"synchronous must be one of {', '.join(DURABILITY_LEVELS)}")
+            db.execute(f'PRAGMA synchronous = {synchronous}')
+
+    def wrote(self):
+        #This is called after each write, it flushes once the group is big enough
+        with self.lock:
+            self.pending += 1
+            if self.pending >= self.max_writes:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        #This commits every waiting write, it is safe to call when nothing is waiting
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.db.in_transaction:
+                self.db.commit()
+            if self.pending > 0:
+                self.flushes += 1
+            self.pending = 0
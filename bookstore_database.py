@@ -2,9 +2,22 @@
 They can add new books to the database, update books information, delete books from the database
 or search the database to find a book. The database is automatically populated with some default
 book stock.
+Nothing is opened until main() runs, so scripts can import from this module without starting
+the menu. bookstore_cli is faster for scripted jobs.
 '''
 #====Module Section====#
-import sqlite3
+import argparse
+import atexit
+from contextlib import nullcontext
+from bookstore_connections import DATABASE_PATH, DURABILITY_LEVELS, GROUP_MAX_WRITES, GROUP_MAX_DELAY, MMAP_SIZE, CACHE_KIB
+from bookstore_repository import BookRepository, id_selection
+from bookstore_cache import CachedBookRepository, LRUCache
+from bookstore_ledger import StockError
+from bookstore_transfer import export_file
+from bookstore_receiving import ScanBatch
+from bookstore_instrument import Instrumentation, SLOW_QUERY_MS, SLOW_QUERY_LOG
+from bookstore_branches import BRANCH_DIRECTORY, branch_database
+from bookstore_replica import ReadReplica, ReplicatedBookRepository, REFRESH_INTERVAL
 
 #This imports the tabulate module, but if the import fails sets the variable to true.
 no_table = False
@@ -16,17 +29,21 @@ except:
 
 #====Database Setup====#
 
-db = sqlite3.connect('ebookstore')
-cursor = db.cursor()
+REPORT_LIMIT = 100
+#the most books listed by the low stock report and by a search on several fields
 
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS
-    books(id INTEGER PRIMARY KEY,Title TEXT UNIQUE NOT NULL, Author TEXT NOT NULL,
-    Qty INTEGER NOT NULL)
-''')
-db.commit()
+CACHE_SIZE = 1024
+CACHE_TTL = 30.0
+#lookups are kept in memory for up to 30 seconds so repeated checks of the same book are instant
+
+repo = None
+#the repository is opened by setup() when the menu starts
+instruments = None
+#with --instrument this times every statement each menu option runs
+
+MENU_OPERATIONS = {1: 'view_books', 2: 'add_book', 3: 'update_book', 4: 'delete_book', 5: 'search_books',
+6: 'import_books', 7: 'export_books', 8: 'stock_reports', 9: 'receive_delivery'}
 
-#this creates a table with four columns and commits it to the database
 default_books = [(3001,'A Tale of Two Cities','Charles Dickens',30),
 (3002,'Harry Potter and the Philosopher\'s Stone','J.K. Rowling',40),
 (3003,'The Lion, the Witch and the Wardrobe','C.S. Lewis',25),
@@ -41,37 +58,72 @@ default_books = [(3001,'A Tale of Two Cities','Charles Dickens',30),
 (3012,'The Pillars of the Earth','Ken Follett',2)]
 
 #Here are our default values to insert into the table, only if the table is empty
-cursor.execute('''
-SELECT COUNT(*) FROM books
-''')
-count = cursor.fetchone()
-
-if count[0] == 0:
-    cursor.executemany('''
-        INSERT INTO books(id, Title, Author, Qty) VALUES(?,?,?,?)''',default_books)
-    db.commit()
-#If the table is empty then the default values are inserted, otherwise they are ignored
-#for these default values id is assigned, new entries will be auto incrimented
 
 #====Function Section====#
+def setup(path=DATABASE_PATH, replica_interval=None, mmap_size=MMAP_SIZE, cache_kib=CACHE_KIB):
+    '''This function opens the repository the menu uses. Opening it creates the books table
+    and its indexes, or upgrades an older database file to match. The connection may be used
+    by the group commit timer thread, which is why it is not tied to this thread. With a
+    replica_interval the lookups read an in-memory copy refreshed at most that often'''
+    global repo
+    books = BookRepository.open(path, mmap_size=mmap_size, cache_kib=cache_kib, check_same_thread=False)
+    if replica_interval is not None:
+        books = ReplicatedBookRepository(books, ReadReplica(path, replica_interval))
+    repo = CachedBookRepository(books, LRUCache(CACHE_SIZE, CACHE_TTL))
+    if repo.count() == 0:
+        repo.add_many(default_books)
+    #If the table is empty then the default values are inserted, otherwise they are ignored
+    #for these default values id is assigned, new entries will be auto incrimented
+    return repo
+
 def view_books():
-    #This function selects every row and displays them for the user
-    cursor.execute('''
-    SELECT * FROM books
-    ''')
-    if no_table == True:
-        for row in cursor:
-            print('ID : {0} Title : {1}. Author : {2}. Quantity : {3}'.format(row[0],row[1],row[2],row[3]))
-    else:
-        book_table(cursor)
-        #if the user has the tabluate module this calls a function with the current cursor
+    '''This function shows the books one page at a time. Only the current page is held in
+    memory, each new page is fetched from the database when the user asks for it'''
+    page = repo.page()
+    if page == []:
+        print("There are no books in the database")
+        return
+    page_number = 1
+    new_page = True
+    while True:
+        if new_page == True:
+            print(f"Page {page_number}")
+            if no_table == True:
+                for row in page:
+                    print('ID : {0} Title : {1}. Author : {2}. Quantity : {3}'.format(row[0],row[1],row[2],row[3]))
+            else:
+                book_table(page)
+                #if the user has the tabluate module this calls a function with the rows of the page
+        new_page = False
+        page_choice = input("Enter n for the next page, p for the previous page or -1 to return to the main menu: ")
+        page_choice = page_choice.strip().lower()
+        if page_choice == '-1':
+            return
+        elif page_choice == 'n':
+            next_page = repo.page(after_id=page[-1][0])
+            if next_page == []:
+                print("This is the last page")
+            else:
+                page = next_page
+                page_number += 1
+                new_page = True
+        elif page_choice == 'p':
+            previous_page = repo.page(before_id=page[0][0])
+            if previous_page == []:
+                print("This is the first page")
+            else:
+                page = previous_page
+                page_number += -1
+                new_page = True
+        else:
+            print("Please enter n, p or -1")
 
-def book_table(cursor):
+def book_table(rows):
     '''this function creates an empty list, then appends the nested data from each object
-    in the cursor to it. This data is used with headers named after the columns to display
+    in the rows to it. This data is used with headers named after the columns to display
     the data in a easy to read grid'''
     book_table = []
-    for book in cursor:
+    for book in rows:
         book_table.append([book[0],book[1],book[2],book[3]])
         #this loop creates a nested list with all the book data
     head = ["ID","Title","Author","Quantity"]
@@ -91,7 +143,7 @@ def add_book():
             return
     if book_check(new_title) == False:
         return
-        #this uses a simple case sensitive check for duplicate titles, returning user to menu if found
+        #this checks for the same title and titles nearly the same, returning user to menu if it is a duplicate
     while True:
         new_author = input("Please enter the author of this book or -1 to abandon book entry: ")
         #This ensures the Author of the book is not null
@@ -116,13 +168,8 @@ def add_book():
             #This avoids errors with stock being set to negative values, the loop exits after check
         except:
             print("Please only enter a numerical value or -1 to abandon book entry: ")
-    new_book = (new_title, new_author, new_qty)
-    #With the inputs checked and assigned to the new_book tuple they are inserted
-    cursor.execute('''
-    INSERT INTO books(Title,Author,Qty)
-    VALUES(?,?,?)
-    ''', new_book)
-    db.commit()
+    #With the inputs checked they are inserted
+    repo.add(new_title, new_author, new_qty)
     #the new book is now in the database with its auto-increment Id as its primary key
 def update_book_find():
     '''This function allows the user to select a book already present in the list
@@ -170,112 +217,89 @@ def update_book_find():
                         print("Please ensure the id is four digits long")
                 except:
                     print("Please enter a number")
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE id = ?) 
-            ''', (update_id,))
-            #this checks if an entry into the database with matching id exists
-            found = cursor.fetchone()
-            #because IDs are unique fetchone is used
-            if found[0] == 0:
+            result = repo.get_by_id(update_id)
+            #this fetches the book with a matching id in one query, or None if there isn't one
+            if result is None:
                 print("ID not found")
             else:
                 #This exits the loop and enters the update phase
                 id_found = True
-                cursor.execute('''
-                SELECT * FROM books WHERE id = ? 
-                ''', (update_id,))
-                result = cursor.fetchone()
-                #the information about the selected book is collected into a variable
                 
     elif update_find_option == 2:
         title_found = False
         #This loop continues until a matching title is entered or -1 is used to exit to main menu
         while title_found == False:
-            update_title = input("Please enter the title of the book you are updating, this is case-sensitive or -1 to return to the main menu: ")
+            update_title = input("Please enter the title of the book you are updating, or the start of any words in it, or -1 to return to the main menu: ")
             if update_title.strip() == '-1':
                 return
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE Title = ?) 
-            ''', (update_title,))
-            found = cursor.fetchone()
-            if found[0] == 0:
+            results = repo.search(update_title, 'Title')
+            if results == []:
                 print("Title not found")
             else:
                 title_found = True
-                cursor.execute('''
-                SELECT * FROM books WHERE Title = ? 
-                ''', (update_title,))
-                result = cursor.fetchone()
-                #The record found is used to pass into the update book change function
+        result = select_book(results)
+        #if several titles match the user picks the one they meant
     elif update_find_option == 3:
         author_found = False
         #this loop continues until a matching author is found or -1 is used to exit
         while author_found == False:
-            update_author = input("Please enter the Author of the book you are updating, this is case-sensitive or -1 to return to the main menu: ")
+            update_author = input("Please enter the Author of the book you are updating, or the start of any of their names, or -1 to return to the main menu: ")
             if update_author.strip() == '-1':
                 return
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE Author = ?) 
-            ''', (update_author,))
-            found = cursor.fetchone()
-            if found[0] == 0:
+            results = repo.search(update_author, 'Author')
+            if results == []:
                 print("Author not found")
             else:
                 #Once an author is found things become more complicated
                 author_found = True
-        results = list()
-        #an empty list of results is made to store all books by the found author
-        cursor.execute('''
-        SELECT * FROM books WHERE Author = ? 
-        ''', (update_author,))
-        for row in cursor:
-            author_result = list()
-            #for each row or book on the cursor a list in the list of results is appended
-            for value in row:
-                author_result.append(value)
-                #Because we are using the search results in the second function all values that might be chosen are needed
-            results.append(author_result)
-            #after the whole cursor is looped through a selection menu is built
-        if len(results) == 1:
-            result = results[0]
-            #if the author only has one book then that book is auto-selected
-        else:
-            x = 1
-            #if the author has multiple books then the user needs to select the one to update
-            if no_table == True:
-                for option in results:
-                    print(f"Enter {x} to select ID:{option[0]} , {option[1]}, {option[2]}, {option[3]} as the book to update")
-                    x += 1
-                    #using x as an iterant integer beside the option variable allows us to use it to select
-            else:
-                #if the user has the tabulate module then the results are built into a grid.
-                    book_table = []
-                    for option in results:
-                        book_table.append([x,option[0],option[1],option[2],option[3]])
-                        x += 1
-                        #this loop creates a nested list with all the book data
-                    head = ["Select","ID","Title","Author","Quantity"]
-                    #the header plus the new list are used to build the table 
-                    print(tabulate(book_table,headers=head,tablefmt="grid"))
-                    print("Enter the selection number to select a book: ")
-                    #functionality wise the table and non table options have the same method of use
-            while True:
-                author_selection = input("")
-                try: 
-                    author_selection = int(author_selection)
-                    if author_selection <= len(results) and author_selection > 0:
-                        author_selection += -1
-                        #it is given minus one to match it up with the index value of the displayed option
-                        result = results[author_selection]
-                        #the final result is the list that matches this selection
-                        break
-                    else:
-                        print("Please enter a valid number, or -1 to return to main menu: ")
-                except:
-                    print("Please enter a number to select an author's book")
+        result = select_book(results)
+    if result is None:
+        return
     #The record found is used to pass into the update book change function
     update_book_change(result)
 
+def select_book(results):
+    '''This function lets the user pick one book from the results of a search.
+    If there is only one result it is selected automatically. It returns None if the user
+    enters -1 to return to the main menu'''
+    if len(results) == 1:
+        return results[0]
+        #if the search only found one book then that book is auto-selected
+    x = 1
+    #if the search found multiple books then the user needs to select the one to update
+    if no_table == True:
+        for option in results:
+            print(f"Enter {x} to select ID:{option[0]} , {option[1]}, {option[2]}, {option[3]} as the book to update")
+            x += 1
+            #using x as an iterant integer beside the option variable allows us to use it to select
+    else:
+        #if the user has the tabulate module then the results are built into a grid.
+        book_table = []
+        for option in results:
+            book_table.append([x,option[0],option[1],option[2],option[3]])
+            x += 1
+            #this loop creates a nested list with all the book data
+        head = ["Select","ID","Title","Author","Quantity"]
+        #the header plus the new list are used to build the table 
+        print(tabulate(book_table,headers=head,tablefmt="grid"))
+        print("Enter the selection number to select a book: ")
+        #functionality wise the table and non table options have the same method of use
+    while True:
+        selection = input("")
+        try: 
+            selection = int(selection)
+            if selection == -1:
+                return None
+            if selection <= len(results) and selection > 0:
+                selection += -1
+                #it is given minus one to match it up with the index value of the displayed option
+                return results[selection]
+                #the final result is the book that matches this selection
+            else:
+                print("Please enter a valid number, or -1 to return to main menu: ")
+        except:
+            print("Please enter a number to select a book")
+
 def update_book_change(search_result):
     #this function uses the results of the search to allow a user to update the book in a way they desire
     print(f"Select what aspect of {search_result[1]} you would like to update or -1 to return to the main menu: ")
@@ -284,9 +308,10 @@ def update_book_change(search_result):
         1: Title
         2: Author
         3: Quantity
+        4: ISBN
         ''')
     else:
-        option_table = [['1:', ' Title'],['2:',' Author'],['3:',' Quantity']]
+        option_table = [['1:', ' Title'],['2:',' Author'],['3:',' Quantity'],['4:',' ISBN']]
         print(tabulate(option_table,tablefmt="grid"))
     while True:
         #This ensures the input is an acceptable integer
@@ -295,7 +320,7 @@ def update_book_change(search_result):
             update_change_option = int(update_change_option)
             if update_change_option == -1:
                 return
-            if update_change_option > 0 and update_change_option < 4:
+            if update_change_option > 0 and update_change_option < 5:
                 break
             else:
                 print("Please select an option from the menu or -1 to return to the main menu: ")
@@ -307,86 +332,145 @@ def update_book_change(search_result):
         #The new title is checked for duplication to reduce errors
         while True:
             new_title = input("Please enter the new title for the book or -1 to return to the main menu: ")
-            if book_check(new_title) != False:
-                break
             if new_title.strip() == '-1':
                 return
+            if book_check(new_title, search_result[0]) != False:
+                break
         #With the final check completed the database is finally updated
-        cursor.execute('''
-        UPDATE books SET Title = ? WHERE id = ?
-        ''',(new_title,search_result[0]))
+        repo.update(search_result[0], title=new_title)
         #The id from the search results is used to find the correct record to update
-        db.commit()
     elif update_change_option ==2:
         print(f"The current Author is: {search_result[2]}")
         new_author = input("Please enter the new author or -1 to return to the main menu: ")
         if new_author.strip() == '-1':
             return
         #Because there can be multiple books by the same author there are less checks needed
-        cursor.execute('''
-        UPDATE books SET Author = ? WHERE id = ?
-        ''',(new_author,search_result[0]))
+        repo.update(search_result[0], author=new_author)
         #The id from the search results is used to find the correct record to update
-        db.commit()
     elif update_change_option == 3:
         print(f"The current Quantity is: {search_result[3]}")
+        #Every change to the stock is recorded in the stock ledger as a sale, restock or adjustment
+        if no_table == True:
+            print('''
+        1: Record a sale
+        2: Record a restock
+        3: Set the stock to a counted quantity
+        ''')
+        else:
+            option_table = [['1:', ' Record a sale'],['2:',' Record a restock'],['3:',' Set the stock to a counted quantity']]
+            print(tabulate(option_table,tablefmt="grid"))
+        while True:
+            stock_option = input("Please select the kind of stock change or -1 to return to main menu: ")
+            try:
+                stock_option = int(stock_option)
+                if stock_option == -1:
+                    return
+                if stock_option > 0 and stock_option < 4:
+                    break
+                else:
+                    print("Please select an option from the menu: ")
+            except:
+                print("Please select an option from the menu: ")
         while True:
-            new_qty = input("Please enter the new quantity of the book or -1 to return to main menu: ")
+            if stock_option == 3:
+                new_qty = input("Please enter the counted quantity of the book or -1 to return to main menu: ")
+            else:
+                new_qty = input("Please enter the number of books or -1 to return to main menu: ")
             try:
                 new_qty = int(new_qty)
                 if new_qty == -1:
                     return
-                if new_qty > 0: 
+                if new_qty > 0 or (new_qty == 0 and stock_option == 3): 
                     break
-                    #The loop continues until the new quantity is positive or -1 is used
+                    #The loop continues until the number is positive, a count can also be zero
                 else:
-                        print("Please ensure the new quantity is positive")
+                        print("Please ensure the number is positive")
             except:
                     print("Please only enter a number")
-        #With the quantity checked it can now be commited to the database
-        cursor.execute('''
-        UPDATE books SET Qty = ? WHERE id = ?
-        ''',(new_qty,search_result[0]))
+        #With the number checked the change is applied to the stock in one atomic update
+        try:
+            if stock_option == 1:
+                new_qty = repo.adjust_stock(search_result[0], -new_qty, 'sale')
+            elif stock_option == 2:
+                new_qty = repo.adjust_stock(search_result[0], new_qty, 'restock')
+            else:
+                new_qty = repo.set_stock(search_result[0], new_qty)
+        except StockError as error:
+            print(f"The stock was not changed, {error}")
+            return
         #The id from the search results is used to find the correct record to update
-        db.commit()
+        print(f"The new Quantity is: {new_qty}")
+    elif update_change_option == 4:
+        #The ISBN is what receiving a delivery finds the book by when its barcode is scanned
+        while True:
+            new_isbn = input("Please scan or enter the ISBN of the book or -1 to return to the main menu: ")
+            if new_isbn.strip() == '-1':
+                return
+            try:
+                found = repo.find_by_isbn(new_isbn)
+            except ValueError as error:
+                print(error)
+                continue
+            if found is not None and found.id != search_result[0]:
+                print(f"This ISBN is already used for {found.Title}")
+                continue
+            break
+        repo.update(search_result[0], isbn=new_isbn)
+        print(f"The ISBN of {search_result[1]} is now set")
 def delete_book():
-    #This function allows the user to select a record to delete using the unique ID.
-    cursor.execute('''
-    SELECT * FROM books
-    ''')
-    ID_list = list()
-    for row in cursor:
-        if no_table == True:
-            print('ID : {0} Title : {1}. Author : {2}. Quantity : {3}'.format(row[0],row[1],row[2],row[3]))
-            #This displays the information about each book for the user if there is no tabulate.
-        ID_list.append(row[0])
-        #This loop displays the books for the user and also builds a list of valid IDs dynamically
-    if no_table == False:
-        #the cursor needs to be reset after ID list is build to be gone through again
-        cursor.execute('''
-        SELECT * FROM books
+    '''This function allows the user to delete books. They can give one or more IDs and ranges
+    of IDs, or clear every book that is out of stock. The number of books that will be deleted
+    is shown first and they are all deleted together once the user confirms'''
+    if no_table == True:
+        print('''
+        1: Delete books by ID
+        2: Delete every book that is out of stock
         ''')
-        book_table(cursor)
-        #If there is a tabulate module then the grid is displayed after the id list is built.
+    else:
+        option_table = [['1:', ' Delete books by ID'],['2:',' Delete every book that is out of stock']]
+        print(tabulate(option_table,tablefmt="grid"))
     while True:
-        deletion_selection = input("Enter the ID of the book you wish to delete or -1 to return to main menu: ")
+        delete_option = input("Please select how you would like to delete books or -1 to return to main menu: ")
         try:
-            deletion_selection = int(deletion_selection)
-            #The input is checked to be an integer and in the list of valid IDs
-            if deletion_selection == -1:
+            delete_option = int(delete_option)
+            if delete_option == -1:
                 return
-            if deletion_selection in ID_list:
-                cursor.execute('''
-                DELETE FROM books WHERE id = ?
-                ''',(deletion_selection,))
-                db.commit()
-                #The deletion is confirmed and a message is displayed for confirmation
-                print("Book successfully deleted")
+            if delete_option == 1 or delete_option == 2:
                 break
             else:
-                print("Please enter a valid ID")
+                print("Please select an option from the menu: ")
         except:
-            print("Please enter a number")
+            print("Please select an option from the menu: ")
+    if delete_option == 1:
+        while True:
+            deletion_selection = input("Enter the IDs to delete separated by commas, a range such as 3001-3005, or -1 to return to main menu: ")
+            if deletion_selection.strip() == '-1':
+                return
+            ids, id_ranges = id_selection(deletion_selection)
+            if ids is None:
+                print("Please enter IDs as numbers, for example 3001, 3004, 3006-3010")
+                continue
+            book_filter = {'ids': ids, 'id_ranges': id_ranges}
+            if repo.delete_where(dry_run=True, **book_filter) == 0:
+                print("Please enter a valid ID")
+            else:
+                break
+    else:
+        book_filter = {'qty': 0}
+        #out of stock books are found through the index on Qty
+    delete_count = repo.delete_where(dry_run=True, **book_filter)
+    #The dry run counts the matching books without deleting them so the user can check first
+    if delete_count == 0:
+        print("There are no books to delete")
+        return
+    confirm = input(f"This will delete {delete_count} books. Enter y to confirm or anything else to cancel: ")
+    if confirm.strip().lower() != 'y':
+        print("No books were deleted")
+        return
+    deleted = repo.delete_where(**book_filter)
+    #The deletion is confirmed and a message is displayed for confirmation
+    print(f"{deleted} books successfully deleted")
+
 def search_books():
     #This function allows the user to search through the database to display records matching their selection
     if no_table == True:
@@ -395,18 +479,19 @@ def search_books():
         2: Title
         3: Author
         4: Quantity
+        5: Several fields at once
         ''')
     else:
-        option_table = [['1:', ' ID'],['2:','Title'],['3:',' Author'],['4:',' Quantity']]
+        option_table = [['1:', ' ID'],['2:','Title'],['3:',' Author'],['4:',' Quantity'],['5:',' Several fields at once']]
         print(tabulate(option_table,tablefmt="grid"))
-    #This logic ensures the option is an integer between 0 and 5. If it is -1 then function is ended
+    #This logic ensures the option is an integer between 0 and 6. If it is -1 then function is ended
     while True:
         search_option = input("Please select how you would like to search for the book or -1 to return to main menu: ")
         try:
             search_option = int(search_option)
             if search_option == -1:
                 return
-            if search_option > 0 and search_option < 5:
+            if search_option > 0 and search_option < 6:
                 break
             else:
                 print("Please select an option from the menu: ")
@@ -424,74 +509,55 @@ def search_books():
                     return
             except:
                 print("Please enter a number")
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE id = ?) 
-            ''', (search_id,))
-            found = cursor.fetchone()
-            if found[0] == 0:
+            result = repo.get_by_id(search_id)
+            if result is None:
                 print("ID not found")
             else:
                 #Once a matching ID is found the whole record of that book is displayed to the user
                 id_found = True
-                cursor.execute('''
-                SELECT * FROM books WHERE id = ? 
-                ''', (search_id,))
                 if no_table == True:
-                    for row in cursor:
-                        print(f"ID: {row[0]}, Title: {row[1]}, Author: {row[2]}, Quantity: {row[3]}")
+                    print(f"ID: {result[0]}, Title: {result[1]}, Author: {result[2]}, Quantity: {result[3]}")
                 else:
-                    book_table(cursor)
+                    book_table([result])
                     #if the user has the tablulate module it will build a small grid to display
 
     elif search_option == 2:
         title_found = False
         #This loop continues until a matching title is entered or -1 is used to exit to main menu
         while title_found == False:
-            search_title = input("Please enter the title of the book, this is case-sensitive or -1 to return to the main menu: ")
+            search_title = input("Please enter the title of the book, or the start of any words in it, or -1 to return to the main menu: ")
             if search_title.strip() == '-1':
                 return
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE Title = ?) 
-            ''', (search_title,))
-            found = cursor.fetchone()
-            if found[0] == 0:
+            results = repo.search(search_title, 'Title')
+            if results == []:
                 print("Title not found")
             else:
-                #Once a matching title is found the whole record of that title is displayed to the user
+                #Every matching title is displayed to the user with the closest matches first
                 title_found = True
-                cursor.execute('''
-                SELECT * FROM books WHERE Title = ? 
-                ''', (search_title,))
                 if no_table == True:
-                    for row in cursor:
+                    for row in results:
                         print(f"ID: {row[0]}, Title: {row[1]}, Author: {row[2]}, Quantity: {row[3]}")
                 else:
-                    book_table(cursor)
-                    #if the user has the tabulate module the record is displayed in a small grid
+                    book_table(results)
+                    #if the user has the tabulate module the records are displayed in a small grid
                 
     elif search_option == 3:
         author_found = False
         while author_found == False:
-            search_author = input("Enter the Author you would like to search for, this is case-sensitive or -1 to return to the main menu: ")
+            search_author = input("Enter the Author you would like to search for, or the start of any of their names, or -1 to return to the main menu: ")
             if search_author.strip() == '-1':
                 return
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE Author = ?) 
-            ''', (search_author,))
-            found = cursor.fetchone()
-            if found[0] == 0:
+            results = repo.search(search_author, 'Author')
+            if results == []:
                 print("Author not found")
             else:
                 author_found = True
-        cursor.execute('''
-        SELECT * FROM books WHERE Author = ?
-        ''',(search_author,))
         if no_table == True:
-            for row in cursor:
+            for row in results:
                 print(f"ID: {row[0]}, Title: {row[1]}, Author: {row[2]}, Quantity: {row[3]}")
             #this prints each matching result for the user,as this can return multiple records
         else:
-            book_table(cursor)
+            book_table(results)
             #This will display a grid of each of an authors works if the user has the tabulate module
 
     elif search_option == 4:
@@ -507,84 +573,339 @@ def search_books():
                     print("Please enter a number only")
             if search_qty == -1:
                 return
-            cursor.execute('''
-            SELECT EXISTS (SELECT * FROM books WHERE Qty = ?) 
-            ''', (search_qty,))
-            found = cursor.fetchone()
-            if found[0] == 0:
+            results = repo.find_by_qty(search_qty)
+            if results == []:
                 print("Quantity not found")
             else:
                 qty_found = True
-            cursor.execute('''
-            SELECT * FROM books WHERE qty = ?
-            ''',(search_qty,))
             if no_table == True:
-                for row in cursor:
+                for row in results:
                     print(f"ID: {row[0]}, Title: {row[1]}, Author: {row[2]}, Quantity: {row[3]}")
                     #this prints each matching result for the user,as this can return multiple records
             else:
-                book_table(cursor)
+                book_table(results)
                 #or if they have the tabulate module a grid of each book with that quantity will be built
 
-def book_check(book_title):
-    #This function is called from the add book function to check that a 
-    #case-sensitive book titles will help reduce duplicate entries
-    cursor.execute('''
-    SELECT * FROM books
-    WHERE Title = ?
-    ''', (book_title,))
-    results = cursor.fetchall()
-    if results != []:
+    elif search_option == 5:
+        composite_search()
+
+def range_input(name):
+    #This asks for the lowest and highest value of name, either can be left blank to leave that end open
+    bounds = []
+    for end in ('lowest', 'highest'):
+        while True:
+            value = input(f"Enter the {end} {name}, or leave it blank for no limit: ").strip()
+            if value == '':
+                bounds.append(None)
+                break
+            try:
+                bounds.append(int(value))
+                break
+            except:
+                print("Please enter a number only")
+    return tuple(bounds)
+
+def composite_search():
+    '''This function asks for any of the title, author, ID range and quantity range and shows the
+    books matching all of them, found with one query. Every question can be left blank to skip it'''
+    title = input("Enter words in the title, or leave it blank: ").strip() or None
+    author = input("Enter words in the author's name, or leave it blank: ").strip() or None
+    id_range = range_input('ID')
+    qty_range = range_input('quantity')
+    orders = {'1': 'relevance', '2': 'id', '3': 'title', '4': 'qty'}
+    order = input("Sort by 1: best match, 2: ID, 3: title or 4: quantity, or leave it blank for the default: ").strip()
+    descending = input("Reverse the order? (y/n): ").strip().lower() == 'y'
+    try:
+        results = repo.composite_search(title, author, id_range, qty_range, orders.get(order), descending, REPORT_LIMIT)
+    except ValueError as error:
+        print(error)
+        return
+    if results == []:
+        print("No books match every filter")
+    elif no_table == True:
+        for row in results:
+            print(f"ID: {row[0]}, Title: {row[1]}, Author: {row[2]}, Quantity: {row[3]}")
+    else:
+        book_table(results)
+
+def book_check(book_title, book_id=None):
+    #This function is called from the add and update book functions to check that a title is not
+    #already in the database. Titles differing only in case, spacing or punctuation are the same title
+    found = repo.find_by_title(book_title)
+    if found is not None and found.id != book_id:
         #if a result is found, meaning a match happened the user cannot add a new entry for this book
         print("This book is already in the database, Please use the update book option from the menu to add additional stock")
         return False
+    similar = [book for book in repo.similar_titles(book_title) if book.id != book_id]
+    #the book being renamed is left out so a small fix to its own title is not shown as a duplicate
+    if similar == []:
+        return True
+    print("These books have nearly the same title:")
+    for book in similar:
+        print(f"ID: {book.id}, Title: {book.Title}, Author: {book.Author}, Quantity: {book.Qty}")
+    answer = input("Is this a different book? (y/n): ")
+    if answer.strip().lower() not in ('y', 'yes'):
+        print("Please use the update book option from the menu to add additional stock")
+        return False
+    return True
 
-#====Menu Section====#
-menu_choice = 0
-#The menu loops until -1 is entered which breaks the loop and closes the program
-while menu_choice != -1:
+def import_books():
+    #This function loads a whole catalog of books from a CSV or JSONL file
+    while True:
+        import_path = input("Please enter the path of the .csv or .jsonl file to import or -1 to return to the main menu: ")
+        import_path = import_path.strip()
+        if import_path == '-1':
+            return
+        try:
+            result = repo.import_books(import_path)
+            break
+        except (OSError, ValueError) as error:
+            print(f"The file could not be imported: {error}")
+    for line_number, reason in result.rejects:
+        print(f"Line {line_number} was not imported: {reason}")
+        #every rejected row is reported so the clerk can fix the file and import just those again
+    print(f"{result.inserted} books imported, {len(result.rejects)} rows rejected")
+
+def export_books():
+    #This function writes every book out to a CSV or JSONL file
+    while True:
+        export_path = input("Please enter the path of the .csv or .jsonl file to export to or -1 to return to the main menu: ")
+        export_path = export_path.strip()
+        if export_path == '-1':
+            return
+        try:
+            written = export_file(repo.db, export_path)
+            break
+        except (OSError, ValueError) as error:
+            print(f"The books could not be exported: {error}")
+    print(f"{written} books exported to {export_path}")
+
+def receive_delivery():
+    '''This function receives a delivery by scanning the barcode of each book, or typing its
+    ISBN. The scans are only counted while the clerk works through the pallet, and the
+    whole delivery is written at once when they finish, in one transaction'''
+    batch = ScanBatch()
+    print("Scan each book or type its ISBN. Enter a blank line when the delivery is finished or -1 to abandon it")
+    while True:
+        scanned = input("").strip()
+        if scanned == '-1':
+            return
+        if scanned == '':
+            break
+        try:
+            isbn = batch.scan(scanned)
+        except ValueError as error:
+            print(f"{error}, please scan it again")
+            continue
+        print(f"{isbn} x {batch.counts[isbn]}")
+        #the running count of each title lets the clerk check it against the delivery note
+    if len(batch) == 0:
+        return
+    result = repo.receive(batch)
+    print(f"{result.units} books received, {result.restocked} titles restocked")
+    if result.unknown == []:
+        return
+    #ISBNs the catalog does not have yet are added as new books once the clerk gives their title and author
+    new_books = ScanBatch()
+    for isbn in result.unknown:
+        print(f"{batch.counts[isbn]} books with the ISBN {isbn} are not in the catalog")
+        title = input("Please enter the title of this book or leave it blank to skip it: ").strip()
+        if title == '':
+            continue
+        if book_check(title) == False:
+            continue
+        author = ''
+        while author == '':
+            author = input("Please enter the author of this book: ").strip()
+        new_books.scan(isbn, batch.counts[isbn], title, author)
+    if len(new_books) > 0:
+        result = repo.receive(new_books)
+        for isbn, reason in result.rejected:
+            print(f"ISBN {isbn} was not added: {reason}")
+        print(f"{result.added} new books added to the catalog")
+
+def stock_reports():
+    #This function shows reports on the stock levels, each is worked out by the database
     if no_table == True:
         print('''
-        1: View current books
-        2: Add new book
-        3: Update book information
-        4: Delete book
-        5: Search for book
-        Or -1 to exit the program''')
-        print("Please select the function you would like to perform:")
+        1: Low stock, books with less than a number in stock
+        2: Books with the most stock
+        3: Books with the least stock
+        4: Total and average stock by author
+        ''')
     else:
-        menu_table = [['1:', ' View current books'],
-        ['2:',' Add new book'],
-        ['3:',' Update book information'],
-        ['4:',' Delete book'],
-        ['5:',' Search for book'],
-        ['-1:',' Exit the program']]
-        menu_header = ["","Option"]
-        print(tabulate(menu_table,headers=menu_header,tablefmt="grid"))
-        print("Please select the function you would like to perform:")
+        option_table = [['1:', ' Low stock, books with less than a number in stock'],['2:',' Books with the most stock'],
+        ['3:',' Books with the least stock'],['4:',' Total and average stock by author']]
+        print(tabulate(option_table,tablefmt="grid"))
     while True:
-        menu_choice = input("")
+        report_option = input("Please select a report or -1 to return to main menu: ")
         try:
-            menu_choice = int(menu_choice)
-            break
+            report_option = int(report_option)
+            if report_option == -1:
+                return
+            if report_option > 0 and report_option < 5:
+                break
+            else:
+                print("Please select an option from the menu: ")
+        except:
+            print("Please select an option from the menu: ")
+    if report_option == 1:
+        prompt = "Please enter the stock level to report books below or -1 to return to main menu: "
+    else:
+        prompt = "Please enter how many results to show or -1 to return to main menu: "
+    while True:
+        report_number = input(prompt)
+        try:
+            report_number = int(report_number)
+            if report_number == -1:
+                return
+            if report_number > 0:
+                break
+            else:
+                print("Please enter a positive number")
         except:
-            print("Please enter a number from the menu")
-    if menu_choice == 1:
-        #calls the view books function
-        view_books()
-    elif menu_choice == 2:
-        #calls the add book function
-        add_book()
-    elif menu_choice == 3:
-        #calls the update book function
-        update_book_find()
-    elif menu_choice == 4:
-        #calls the delete book function
-        delete_book()
-    elif menu_choice == 5:
-        #calls the search book function
-        search_books()
+            print("Please only enter a number")
+    if report_option == 4:
+        totals = repo.author_totals(limit=report_number)
+        if no_table == True:
+            for total in totals:
+                print(f"Author: {total[0]}, Books: {total[1]}, Total stock: {total[2]}, Average stock: {total[3]:.1f}")
+        else:
+            head = ["Author","Books","Total stock","Average stock"]
+            print(tabulate([[total[0],total[1],total[2],round(total[3],1)] for total in totals],headers=head,tablefmt="grid"))
+        return
+    if report_option == 1:
+        print(f"{repo.low_stock_count(report_number)} books have less than {report_number} in stock")
+        results = repo.low_stock(report_number, REPORT_LIMIT)
+        #only the lowest are listed so a large catalog does not flood the screen
+    elif report_option == 2:
+        results = repo.top_by_qty(report_number)
+    else:
+        results = repo.bottom_by_qty(report_number)
+    if no_table == True:
+        for row in results:
+            print(f"ID: {row[0]}, Title: {row[1]}, Author: {row[2]}, Quantity: {row[3]}")
+    else:
+        book_table(results)
+
+#====Menu Section====#
+def main(arguments=None):
+    global instruments
+    parser = argparse.ArgumentParser(description='The bookstore database menu for clerks.')
+    parser.add_argument('--group-commit', action='store_true',
+        help='commit writes together in groups, for receiving large deliveries quickly')
+    parser.add_argument('--group-size', type=int, default=GROUP_MAX_WRITES, help='writes in each group')
+    parser.add_argument('--group-delay', type=float, default=GROUP_MAX_DELAY, help='most seconds a write waits to be committed')
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, type=str.upper,
+        help='how carefully commits are synced to disk, FULL, NORMAL or OFF')
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--branch', help='use this branch\'s database file instead')
+    parser.add_argument('--branches', default=BRANCH_DIRECTORY, help='the directory holding the branch files')
+    parser.add_argument('--replica', action='store_true',
+        help='search and list books from an in-memory copy of the database, writes still go to the file')
+    parser.add_argument('--replica-interval', type=float, default=REFRESH_INTERVAL,
+        help='most seconds the copy can lag behind other clerks\' changes')
+    parser.add_argument('--mmap-size', type=int, default=MMAP_SIZE, help='bytes of the database file to memory map')
+    parser.add_argument('--cache-kib', type=int, default=CACHE_KIB, help='KiB of SQLite page cache')
+    parser.add_argument('--instrument', action='store_true',
+        help='time every statement and print a summary when the program exits')
+    parser.add_argument('--slow-ms', type=float, default=SLOW_QUERY_MS, help='statements slower than this are logged with their plan')
+    parser.add_argument('--slow-log', default=SLOW_QUERY_LOG, help='the file slow statements are written to, empty for none')
+    options = parser.parse_args(arguments)
+    path = options.database
+    if options.branch is not None:
+        try:
+            path = branch_database(options.branch, options.branches)
+        except ValueError as error:
+            parser.error(str(error))
+    setup(path, options.replica_interval if options.replica else None, options.mmap_size, options.cache_kib)
+    if options.instrument:
+        instruments = Instrumentation(options.slow_ms, options.slow_log)
+        instruments.attach(repo.db)
+        atexit.register(lambda: print(instruments.summary()))
+        #the summary is printed however the program ends
+    if options.group_commit:
+        repo.start_group_commit(options.group_size, options.group_delay, options.durability)
+    elif options.durability is not None:
+        repo.db.execute(f'PRAGMA synchronous = {options.durability}')
+    menu_choice = 0
+    #The menu loops until -1 is entered which breaks the loop and closes the program
+    while menu_choice != -1:
+        if no_table == True:
+            print('''
+            1: View current books
+            2: Add new book
+            3: Update book information
+            4: Delete book
+            5: Search for book
+            6: Import books from a file
+            7: Export books to a file
+            8: Stock reports
+            9: Receive a delivery by barcode
+            Or -1 to exit the program''')
+            print("Please select the function you would like to perform:")
+        else:
+            menu_table = [['1:', ' View current books'],
+            ['2:',' Add new book'],
+            ['3:',' Update book information'],
+            ['4:',' Delete book'],
+            ['5:',' Search for book'],
+            ['6:',' Import books from a file'],
+            ['7:',' Export books to a file'],
+            ['8:',' Stock reports'],
+            ['9:',' Receive a delivery by barcode'],
+            ['-1:',' Exit the program']]
+            menu_header = ["","Option"]
+            print(tabulate(menu_table,headers=menu_header,tablefmt="grid"))
+            print("Please select the function you would like to perform:")
+        while True:
+            menu_choice = input("")
+            try:
+                menu_choice = int(menu_choice)
+                break
+            except:
+                print("Please enter a number from the menu")
+        operation = nullcontext()
+        if instruments is not None and menu_choice in MENU_OPERATIONS:
+            operation = instruments.operation(MENU_OPERATIONS[menu_choice])
+            #the time the clerk spends typing is not counted, only the statements the option runs
+        with operation:
+            if menu_choice == 1:
+                #calls the view books function
+                view_books()
+            elif menu_choice == 2:
+                #calls the add book function
+                add_book()
+            elif menu_choice == 3:
+                #calls the update book function
+                update_book_find()
+            elif menu_choice == 4:
+                #calls the delete book function
+                delete_book()
+            elif menu_choice == 5:
+                #calls the search book function
+                search_books()
+            elif menu_choice == 6:
+                #calls the import books function
+                import_books()
+            elif menu_choice == 7:
+                #calls the export books function
+                export_books()
+            elif menu_choice == 8:
+                #calls the stock reports function
+                stock_reports()
+            elif menu_choice == 9:
+                #calls the receive delivery function
+                receive_delivery()
+
+    repo.flush()
+    #Any writes still waiting in group commit mode are committed before the program ends
+    print("Thank you for using the Bookstore database ")
+    if instruments is not None:
+        instruments.detach(repo.db)
+        #any slow statements left are logged while the connection is still open
+    #Closes the database connection
+    repo.close()
 
-print("Thank you for using the Bookstore database ")
-#Closes the database connection
-db.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
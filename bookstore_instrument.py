@@ -0,0 +1,223 @@
+'''This module measures where the time goes in the database, to find out which statement is
+to blame when a clerk says a search is slow. It hooks into a connection with the sqlite3
+trace callback, which is called as each statement starts, and the progress handler, which
+SQLite calls every few hundred instructions while a statement runs. A statement's time is
+from its start to the last progress call it made, so time the clerk spends reading the screen
+between two statements is never counted against either of them.
+
+Statements are grouped by their text with the values taken out, and by the operation they
+ran in, such as a menu option. Statements slower than the threshold are written to the slow
+query log together with their EXPLAIN QUERY PLAN, and summary() gives a table of the counts
+and latencies that can be printed when the program exits.
+'''
+#====Module Section====#
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+SLOW_QUERY_MS = 100.0
+#statements that take longer than this are written to the slow query log
+SLOW_QUERY_LOG = 'slow_queries.log'
+PROGRESS_STEPS = 100
+#SQLite instructions between progress calls, fewer gives finer timing but costs more
+PLANNED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+#the statements EXPLAIN QUERY PLAN has a plan for
+
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SPACE = re.compile(r'\s+')
+
+
+#====Function Section====#
+def statement_key(sql):
+    #This takes the values out of a traced statement so every run of it is counted together
+    return SPACE.sub(' ', LITERAL.sub('?', sql)).strip()
+
+
+#====Class Section====#
+class Instrumentation:
+    '''This class collects the counts and latencies of every statement run on the
+    connections attached to it. Work is grouped into operations with the operation()
+    context manager, and the slow statements found during an operation have their plans
+    looked up and logged when it ends, as SQLite cannot run a statement from inside its
+    own trace callback. It is safe to attach connections used by different threads'''
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS, slow_log=SLOW_QUERY_LOG, progress_steps=PROGRESS_STEPS):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.progress_steps = progress_steps
+        self.operations = {}
+        self.statements = {}
+        self.slow_queries = 0
+        self._connections = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def attach(self, db):
+        '''This function starts timing every statement run on db. Each connection has its
+        own record of the statement running on it'''
+        state = {'db': db, 'current': None, 'slow': [], 'thread': None}
+
+        def traced(sql):
+            if sql.startswith('--'):
+                return
+                #SQLite runs statements of its own inside full-text searches, their time belongs to the search
+            if state['current'] is not None and state['current'][0] == sql:
+                return
+                #statements run by a trigger are traced again with the text of the statement that fired it
+            self._finish(state)
+            now = time.perf_counter()
+            state['current'] = [sql, self.operation_name(), now, now, 0]
+            state['thread'] = threading.get_ident()
+
+        def progress():
+            current = state['current']
+            if current is not None:
+                current[3] = time.perf_counter()
+                current[4] += 1
+            return 0
+
+        state['callbacks'] = (traced, progress)
+        self._hook(state)
+        with self._lock:
+            self._connections.append(state)
+        return db
+
+    def _hook(self, state):
+        traced, progress = state['callbacks']
+        state['db'].set_trace_callback(traced)
+        state['db'].set_progress_handler(progress, self.progress_steps)
+
+    def detach(self, db):
+        with self._lock:
+            states = [state for state in self._connections if state['db'] is db]
+            self._connections = [state for state in self._connections if state['db'] is not db]
+        for state in states:
+            self._finish(state)
+            self._explain(state)
+        db.set_trace_callback(None)
+        db.set_progress_handler(None, 0)
+
+    def operation_name(self):
+        return getattr(self._local, 'operation', None)
+
+    @contextmanager
+    def operation(self, name):
+        '''This context manager counts the work done inside it as one run of the named
+        operation. Its latency is the time spent in SQLite, not the time waiting for input'''
+        outer = self.operation_name()
+        self._local.operation = name
+        with self._lock:
+            self.operations.setdefault(name, [0, 0.0, 0.0, 0])[0] += 1
+        try:
+            yield
+        finally:
+            for state in self._thread_connections():
+                self._finish(state)
+                self._explain(state)
+            self._local.operation = outer
+
+    def _thread_connections(self):
+        #Operations are per thread, so only the connections this thread last ran a statement on are finished
+        thread = threading.get_ident()
+        with self._lock:
+            return [state for state in self._connections if state['thread'] == thread]
+
+    def _finish(self, state):
+        #This records the statement running on a connection now that it has finished
+        current = state['current']
+        if current is None:
+            return
+        state['current'] = None
+        sql, operation, start, last, steps = current
+        elapsed_ms = (last - start) * 1000
+        key = statement_key(sql)
+        with self._lock:
+            timing = self.statements.setdefault((operation, key), [0, 0.0, 0.0, 0])
+            timing[0] += 1
+            timing[1] += elapsed_ms
+            timing[2] = max(timing[2], elapsed_ms)
+            timing[3] += steps
+            if operation is not None:
+                totals = self.operations[operation]
+                totals[1] += elapsed_ms
+                totals[2] = max(totals[2], elapsed_ms)
+                totals[3] += 1
+        if self.slow_ms is not None and elapsed_ms >= self.slow_ms:
+            state['slow'].append((sql, operation, elapsed_ms))
+
+    def _explain(self, state):
+        '''This function writes the slow statements found on a connection to the slow query
+        log with their plans. The callbacks are taken off while the plans are read so the
+        EXPLAIN statements are not timed themselves'''
+        slow, state['slow'] = state['slow'], []
+        if slow == []:
+            return
+        db = state['db']
+        db.set_trace_callback(None)
+        db.set_progress_handler(None, 0)
+        entries = []
+        try:
+            for sql, operation, elapsed_ms in slow:
+                plan = []
+                if sql.lstrip().split(None, 1)[0].upper() in PLANNED:
+                    try:
+                        plan = [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql)]
+                    except Exception as error:
+                        plan = [f'no plan: {error}']
+                entries.append((sql, operation, elapsed_ms, plan))
+        finally:
+            with self._lock:
+                attached = state in self._connections
+            if attached:
+                self._hook(state)
+        with self._lock:
+            self.slow_queries += len(entries)
+            if not self.slow_log:
+                return
+            with open(self.slow_log, 'a', encoding='utf-8') as log:
+                for sql, operation, elapsed_ms, plan in entries:
+                    log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {elapsed_ms:.1f}ms "
+                        f"operation={operation or '-'}\n    {SPACE.sub(' ', sql).strip()}\n")
+                    for line in plan:
+                        log.write(f'        {line}\n')
+
+    def report(self):
+        '''This returns the operation and statement timings, the statements that took the most
+        time first. steps is the number of progress calls, a rough measure of the work SQLite did'''
+        with self._lock:
+            operations = {name: {'count': count, 'statements': statements, 'total_ms': round(total_ms, 3),
+                'max_statement_ms': round(max_ms, 3)}
+                for name, (count, total_ms, max_ms, statements) in self.operations.items()}
+            statements = [{'operation': operation, 'statement': key, 'count': count,
+                'total_ms': round(total_ms, 3), 'max_ms': round(max_ms, 3), 'steps': steps}
+                for (operation, key), (count, total_ms, max_ms, steps) in self.statements.items()]
+        statements.sort(key=lambda timing: timing['total_ms'], reverse=True)
+        return {'operations': operations, 'statements': statements, 'slow_queries': self.slow_queries}
+
+    def summary(self, limit=20):
+        '''This function returns the report as text, one line for each operation and then
+        the limit statements that took the most time in total'''
+        with self._lock:
+            states = list(self._connections)
+        for state in states:
+            self._finish(state)
+            self._explain(state)
+        report = self.report()
+        lines = ['Operation                       runs  statements    total ms  slowest ms']
+        for name, timing in sorted(report['operations'].items()):
+            lines.append(f"{name[:30]:<30} {timing['count']:>5} {timing['statements']:>11} "
+                f"{timing['total_ms']:>11.2f} {timing['max_statement_ms']:>11.2f}")
+        lines.append('')
+        lines.append('Operation       Statement                                            runs    total ms   mean ms    max ms')
+        for timing in report['statements'][:limit]:
+            statement = timing['statement']
+            if len(statement) > 50:
+                statement = statement[:47] + '...'
+            operation = (timing['operation'] or '-')[:15]
+            lines.append(f"{operation:<15} {statement:<50} {timing['count']:>7} {timing['total_ms']:>11.2f} "
+                f"{timing['total_ms'] / timing['count']:>9.3f} {timing['max_ms']:>9.2f}")
+        if report['slow_queries'] > 0 and self.slow_log:
+            lines.append('')
+            lines.append(f"{report['slow_queries']} slow statements were written to {self.slow_log}")
+        return '\n'.join(lines)
@@ -0,0 +1,140 @@
+'''This module records every change to a book's stock as a movement in the stock ledger.
+Sales, restocks and adjustments are applied as Qty = Qty + change in the same statement that
+checks the result, so two tills selling the same book at once can never lose a sale, and the
+movement is written in the same transaction. Compaction folds old movements into a snapshot
+per book so the ledger stays small, while books.Qty is always the current stock.
+
+    python bookstore_ledger.py --days 30      fold movements older than 30 days
+'''
+#====Module Section====#
+import argparse
+from collections import namedtuple
+
+from bookstore_connections import DATABASE_PATH, open_connection
+
+KINDS = ('sale', 'restock', 'adjustment')
+COMPACT_AFTER_DAYS = 30
+#movements older than this are folded into the snapshots by default
+
+Movement = namedtuple('Movement', ['id', 'book_id', 'kind', 'delta', 'note', 'created_at'])
+
+
+class StockError(ValueError):
+    #This is raised when a movement would take the stock below zero or the book does not exist
+    pass
+
+
+#====Function Section====#
+def record_movement(db, book_id, kind, delta, note=None, commit=True):
+    '''This function applies a change to a book's stock and records it, returning the new
+    quantity. A sale is given as a negative delta. The update only happens if the stock stays
+    at zero or above, which SQLite checks while holding the write lock, so there is no gap
+    between reading the stock and writing it for another clerk to change it in'''
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    try:
+        cursor = db.execute('''
+        UPDATE books SET Qty = Qty + ? WHERE id = ? AND Qty + ? >= 0
+        ''', (delta, book_id, delta))
+        if cursor.rowcount == 0:
+            if db.execute('SELECT 1 FROM books WHERE id = ?', (book_id,)).fetchone() is None:
+                raise StockError(f'there is no book with the id {book_id}')
+            raise StockError('there is not enough stock for this change')
+        db.execute('''
+        INSERT INTO stock_movements(book_id, kind, delta, note) VALUES(?,?,?,?)
+        ''', (book_id, kind, delta, note))
+        qty = db.execute('SELECT Qty FROM books WHERE id = ?', (book_id,)).fetchone()[0]
+    except Exception:
+        if commit and db.in_transaction:
+            db.rollback()
+        raise
+    if commit:
+        db.commit()
+    return qty
+
+def set_stock(db, book_id, qty, note=None, commit=True):
+    '''This function sets a book's stock to a counted quantity and records the difference
+    as an adjustment. The write lock is taken before the old quantity is read so the
+    difference recorded is exactly the change made'''
+    if qty < 0:
+        raise StockError('the stock cannot be negative')
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute('SELECT Qty FROM books WHERE id = ?', (book_id,)).fetchone()
+        if row is None:
+            raise StockError(f'there is no book with the id {book_id}')
+        if qty != row[0]:
+            db.execute('UPDATE books SET Qty = ? WHERE id = ?', (qty, book_id))
+            db.execute('''
+            INSERT INTO stock_movements(book_id, kind, delta, note) VALUES(?,?,?,?)
+            ''', (book_id, 'adjustment', qty - row[0], note))
+    except Exception:
+        if commit:
+            db.rollback()
+        raise
+    if commit:
+        db.commit()
+    return qty
+
+def movements(db, book_id, limit=50):
+    #This returns a book's most recent movements that have not been compacted yet, newest first
+    return [Movement._make(row) for row in db.execute('''
+    SELECT id, book_id, kind, delta, note, created_at FROM stock_movements
+    WHERE book_id = ? ORDER BY id DESC LIMIT ?
+    ''', (book_id, limit))]
+
+def snapshot(db, book_id):
+    #This returns the (qty, movement_id, taken_at) the book's history was compacted to, or None
+    return db.execute('''
+    SELECT qty, movement_id, taken_at FROM stock_snapshots WHERE book_id = ?
+    ''', (book_id,)).fetchone()
+
+def compact_movements(db, older_than_days=COMPACT_AFTER_DAYS):
+    '''This function folds every movement older than the given number of days into the
+    book's snapshot and deletes those movements. The snapshot is the stock the book had
+    straight after its last folded movement, worked out as the current stock less the
+    movements that are being kept, so it stays right even if Qty was set some other way.
+    It returns the number of movements folded'''
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        cutoff = db.execute('''
+        SELECT MAX(id) FROM stock_movements WHERE created_at < datetime('now', ?)
+        ''', (f'-{older_than_days} days',)).fetchone()[0]
+        if cutoff is None:
+            db.rollback()
+            return 0
+        db.execute('''
+        INSERT INTO stock_snapshots(book_id, qty, movement_id, taken_at)
+        SELECT folded.book_id,
+            books.Qty - COALESCE((SELECT SUM(kept.delta) FROM stock_movements AS kept
+                WHERE kept.book_id = folded.book_id AND kept.id > ?), 0),
+            folded.last_id, CURRENT_TIMESTAMP
+        FROM (SELECT book_id, MAX(id) AS last_id FROM stock_movements WHERE id <= ? GROUP BY book_id) AS folded
+        JOIN books ON books.id = folded.book_id
+        WHERE true
+        ON CONFLICT(book_id) DO UPDATE SET qty = excluded.qty, movement_id = excluded.movement_id,
+            taken_at = excluded.taken_at
+        ''', (cutoff, cutoff))
+        #movements of books that have since been deleted are dropped without a snapshot
+        folded = db.execute('''
+        DELETE FROM stock_movements WHERE id <= ?
+        ''', (cutoff,)).rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return folded
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Fold old stock movements into per-book snapshots.')
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--days', type=int, default=COMPACT_AFTER_DAYS, help='fold movements older than this')
+    options = parser.parse_args(arguments)
+    db = open_connection(options.database)
+    folded = compact_movements(db, options.days)
+    db.close()
+    print(f"{folded} stock movements compacted")
+
+if __name__ == '__main__':
+    main()
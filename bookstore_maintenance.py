@@ -0,0 +1,231 @@
+'''This module keeps the database file in good shape while the shop stays open. Each task is
+done in small steps or without taking the write lock, so a clerk's write never waits long:
+
+    authors      deletes authors left without any books
+    vacuum       hands the free pages left by deletes back to the file system, a few at a time
+    analyze      gathers the statistics the query planner uses to pick an index
+    checkpoint   copies the WAL back into the database file so the WAL stays small
+    backup       copies the database to another file with the backup API, a few pages at a time
+
+Every task reports how long it took and the size of the database file and its WAL before and
+after. The tasks can be run once, or every so many seconds until the program is stopped.
+
+    python bookstore_maintenance.py                              every task but backup, once
+    python bookstore_maintenance.py --backup backups/shop.db     and take a backup
+    python bookstore_maintenance.py --every 3600 --backup "backups/shop-%Y%m%d-%H%M.db"
+'''
+#====Module Section====#
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from bookstore_connections import DATABASE_PATH, open_connection
+
+TASKS = ('authors', 'vacuum', 'analyze', 'checkpoint', 'backup')
+#in the order they run, the file only shrinks once the vacuum is checkpointed
+VACUUM_STEP_PAGES = 256
+#free pages handed back in each write transaction of the vacuum
+BACKUP_STEP_PAGES = 256
+#pages copied in each step of a backup
+STEP_PAUSE = 0.01
+#seconds between steps so a clerk's write can go in between
+BACKUP_RESTARTS = 3
+#times a backup can be started again by clerks' writes before it is finished in one step
+ANALYSIS_LIMIT = 1000
+#rows ANALYZE looks at in each index, which keeps it quick on a large catalog
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+#PASSIVE never waits for a clerk, the others wait for readers and writers to finish
+
+TaskReport = namedtuple('TaskReport', ['task', 'seconds', 'size_before', 'size_after', 'detail'])
+#the sizes are the bytes of the database file and its WAL together
+
+
+class BackupRestarted(Exception):
+    #This is raised inside a backup to stop copying in steps once clerks' writes have restarted it too often
+    pass
+
+
+#====Function Section====#
+def file_size(path):
+    #This returns the bytes used on disk by the database file and its WAL
+    return sum(os.path.getsize(name) for name in (path, path + '-wal') if os.path.exists(name))
+
+def prune_authors(db):
+    #This deletes every author with no books left, each is checked through the index on books.author_id
+    deleted = db.execute('''
+    DELETE FROM authors WHERE NOT EXISTS (SELECT 1 FROM books WHERE books.author_id = authors.id)
+    ''').rowcount
+    db.commit()
+    return f'{deleted} authors without books deleted'
+
+def incremental_vacuum(db, step_pages=VACUUM_STEP_PAGES, pause=STEP_PAUSE):
+    '''This function hands the free pages back to the file system step_pages at a time, each
+    step its own short write transaction, so a clerk waits for one step at most. In WAL mode
+    the file itself only gets smaller at the next checkpoint'''
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 'auto_vacuum is not INCREMENTAL, the file needs a full VACUUM first'
+    freed = 0
+    while True:
+        free = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if free == 0:
+            break
+        try:
+            db.executescript(f'BEGIN IMMEDIATE; PRAGMA incremental_vacuum({int(step_pages)}); COMMIT;')
+            #execute() would stop the pragma after its first page, executescript runs it to the end
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        freed += free - db.execute('PRAGMA freelist_count').fetchone()[0]
+        time.sleep(pause)
+    return f'{freed} free pages handed back'
+
+def analyze(db, analysis_limit=ANALYSIS_LIMIT):
+    '''This function brings the query planner's statistics up to date. analysis_limit stops
+    ANALYZE reading every row of a large index, the planner only needs a rough count'''
+    db.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+    db.execute('ANALYZE')
+    db.commit()
+    tables = db.execute('SELECT COUNT(DISTINCT tbl) FROM sqlite_stat1').fetchone()[0]
+    return f'statistics gathered for {tables} tables'
+
+def checkpoint(db, mode='PASSIVE'):
+    #This copies what it can of the WAL back into the database file, see CHECKPOINT_MODES
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"mode must be one of {', '.join(CHECKPOINT_MODES)}")
+    busy, wal_pages, copied = db.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+    if busy:
+        return f'{copied} of {wal_pages} WAL pages copied, a clerk was busy so the rest are left for next time'
+    return f'{copied} of {wal_pages} WAL pages copied'
+
+def backup(db, target, step_pages=BACKUP_STEP_PAGES, pause=STEP_PAUSE, restart_limit=BACKUP_RESTARTS):
+    '''This function copies the database to target with the sqlite3 backup API, step_pages
+    at a time with a pause between steps. The copy is written to a temporary file and only
+    renamed to target when it is complete, so target is never a half finished backup.
+    A write by another clerk makes SQLite start the copy again, so if a busy shop restarts it
+    more than restart_limit times the rest is copied in one step. In WAL mode that step only
+    reads a snapshot of the file, which does not block a clerk's write either'''
+    directory = os.path.dirname(target)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    partial = target + '.partial'
+    state = {'restarts': 0, 'remaining': None}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > restart_limit:
+                raise BackupRestarted()
+        state['remaining'] = remaining
+        time.sleep(pause)
+
+    copy = sqlite3.connect(partial)
+    try:
+        try:
+            db.backup(copy, pages=step_pages, progress=progress)
+            how = f'in steps, restarted {state["restarts"]} times'
+        except BackupRestarted:
+            db.backup(copy)
+            how = f'in one step after {restart_limit} restarts'
+    finally:
+        copy.close()
+    os.replace(partial, target)
+    return f'{os.path.getsize(target)} bytes backed up to {target} {how}'
+
+def run_task(db, path, task, backup_path=None):
+    #This runs one task and times it, backup_path can contain strftime codes such as %Y%m%d
+    size_before = file_size(path)
+    start = time.perf_counter()
+    if task == 'authors':
+        detail = prune_authors(db)
+    elif task == 'vacuum':
+        detail = incremental_vacuum(db)
+    elif task == 'analyze':
+        detail = analyze(db)
+    elif task == 'checkpoint':
+        detail = checkpoint(db)
+    elif task == 'backup':
+        detail = backup(db, time.strftime(backup_path))
+    else:
+        raise ValueError(f"task must be one of {', '.join(TASKS)}")
+    return TaskReport(task, time.perf_counter() - start, size_before, file_size(path), detail)
+
+def run_maintenance(path=DATABASE_PATH, tasks=None, backup_path=None):
+    '''This function runs the tasks on their own connection and returns a TaskReport for each.
+    By default that is every task, leaving out backup unless a backup_path is given'''
+    if tasks is None:
+        tasks = [task for task in TASKS if task != 'backup' or backup_path is not None]
+    if 'backup' in tasks and backup_path is None:
+        raise ValueError('a backup needs a path to write to')
+    db = open_connection(path)
+    try:
+        return [run_task(db, path, task, backup_path) for task in TASKS if task in tasks]
+    finally:
+        db.close()
+
+def describe(report):
+    #This returns one line about a finished task
+    return (f'{report.task:<10} {report.seconds * 1000:>9.1f} ms  {report.size_before:>12} -> '
+        f'{report.size_after:>12} bytes  {report.detail}')
+
+
+#====Class Section====#
+class MaintenanceScheduler:
+    '''This class runs the maintenance tasks every interval seconds on a thread of its own,
+    until stop() is called. Each finished run's reports are passed to report, and a run that
+    fails is reported and tried again at the next interval'''
+
+    def __init__(self, path=DATABASE_PATH, interval=3600.0, tasks=None, backup_path=None, report=None):
+        self.path = path
+        self.interval = interval
+        self.tasks = tasks
+        self.backup_path = backup_path
+        self.report = report or (lambda reports: print('\n'.join(describe(task) for task in reports)))
+        self.runs = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='bookstore-maintenance', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def run(self):
+        #The first run starts straight away, then one every interval until stopped
+        while not self._stopped.is_set():
+            try:
+                self.report(run_maintenance(self.path, self.tasks, self.backup_path))
+            except (sqlite3.Error, OSError) as error:
+                print(f'Maintenance failed: {error}')
+            self.runs += 1
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Vacuum, analyze, checkpoint and back up the bookstore database.')
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, help='only run these tasks')
+    parser.add_argument('--backup', metavar='PATH', help='back up to this file, it can contain strftime codes')
+    parser.add_argument('--every', type=float, metavar='SECONDS', help='run again every so many seconds until stopped')
+    options = parser.parse_args(arguments)
+    if options.tasks is not None and 'backup' in options.tasks and options.backup is None:
+        parser.error('the backup task needs --backup PATH')
+    if options.every is None:
+        for report in run_maintenance(options.database, options.tasks, options.backup):
+            print(describe(report))
+        return
+    scheduler = MaintenanceScheduler(options.database, options.every, options.tasks, options.backup)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
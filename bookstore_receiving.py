@@ -0,0 +1,199 @@
+'''This module receives a delivery by scanning the barcode on each book. A scanner types the
+ISBN and presses Enter, so a pallet arrives as a fast stream of ISBNs with each title repeated
+many times. The scans are counted up in memory by a ScanBatch and nothing is written until
+the delivery is finished. Then every title is applied at once, with one batched
+INSERT ... ON CONFLICT DO UPDATE SET Qty = Qty + excluded.Qty in a single transaction. A title
+already in the catalog has its stock increased, and a new title is added when the scan file
+gives its title and author. Every title received is recorded in the stock ledger as a restock.
+
+A scan file has one scan per line: an ISBN on its own, or followed by the quantity, and for a
+book that is new to the catalog its title and author, separated by commas.
+
+    9780261103573
+    978-0-261-10357-3,12
+    9781529416077,6,Mordew,Alex Pheby
+
+    python bookstore_receiving.py delivery.txt          receive a scan file
+    python bookstore_receiving.py - < delivery.txt      read the scans from stdin
+'''
+#====Module Section====#
+import argparse
+import csv
+import json
+import re
+import sys
+from collections import Counter, namedtuple
+
+from bookstore_connections import DATABASE_PATH, open_connection
+from bookstore_search import title_key
+
+RECEIVE_NOTE = 'received'
+#the note on the restock movements recorded for a delivery
+
+ISBN_10 = re.compile(r'[0-9]{9}[0-9X]')
+ISBN_13 = re.compile(r'97[89][0-9]{10}')
+#every ISBN-13 starts 978 or 979, which stops a price or shelf barcode being taken for a book
+ISBN_SEPARATORS = re.compile(r'[\s-]')
+
+Received = namedtuple('Received', ['restocked', 'added', 'units', 'unknown', 'rejected'])
+#restocked and added count titles, unknown lists the ISBNs with no book and no title to add
+#one with, and rejected has an (ISBN, reason) for each new title that could not be added
+
+
+#====Function Section====#
+def isbn13_check_digit(digits):
+    #This works out the last digit of an ISBN-13 from its first 12, the digits weigh 1 and 3 in turn
+    total = sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(digits))
+    return str(-total % 10)
+
+def normalise_isbn(text):
+    '''This function checks an ISBN-10 or ISBN-13 and returns it as the 13 digits of its
+    ISBN-13, so a book is stored and found the same way whatever was scanned or typed.
+    Hyphens and spaces are ignored. ValueError is raised if it is not an ISBN or its check
+    digit is wrong, which is how a misread barcode is caught'''
+    digits = ISBN_SEPARATORS.sub('', str(text)).upper()
+    if ISBN_10.fullmatch(digits):
+        total = sum((10 - position) * (10 if digit == 'X' else int(digit)) for position, digit in enumerate(digits))
+        if total % 11 != 0:
+            raise ValueError(f'{text} is not a valid ISBN, its check digit is wrong')
+        return '978' + digits[:9] + isbn13_check_digit('978' + digits[:9])
+    if ISBN_13.fullmatch(digits):
+        if isbn13_check_digit(digits[:12]) != digits[12]:
+            raise ValueError(f'{text} is not a valid ISBN, its check digit is wrong')
+        return digits
+    raise ValueError(f'{text} is not an ISBN, it needs 10 digits or 13 starting 978 or 979')
+
+def receive(db, batch, note=RECEIVE_NOTE, commit=True):
+    '''This function applies a whole delivery in one transaction and returns a Received.
+    The books already holding the scanned ISBNs are found with one indexed query, and so are
+    any books already having the title of a new ISBN, as those cannot be added again. Every
+    title is then written by one executemany of the upsert: the unique ISBN index finds a
+    book already in the catalog and adds to its Qty, and a new ISBN inserts its book. The
+    write lock is taken first so no other clerk can add one of the ISBNs in between'''
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+    try:
+        known = {row[0]: row[1:] for row in db.execute('''
+        SELECT books.isbn, books.Title, books.title_key, authors.Name FROM books
+        JOIN authors ON authors.id = books.author_id
+        WHERE books.isbn IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(batch.counts)),))}
+        keys = {isbn: title_key(title) for isbn, (title, author) in batch.titles.items() if isbn not in known}
+        taken = {row[0] for row in db.execute('''
+        SELECT title_key FROM books WHERE title_key IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(keys.values())),))}
+        rows = []
+        unknown = []
+        rejected = []
+        for isbn, qty in batch.counts.items():
+            if isbn in known:
+                title, key, author = known[isbn]
+            elif isbn not in keys:
+                unknown.append(isbn)
+                continue
+            elif keys[isbn] in taken:
+                rejected.append((isbn, 'the title is already in the catalog, give the book this ISBN with update'))
+                continue
+            else:
+                (title, author), key = batch.titles[isbn], keys[isbn]
+                taken.add(key)
+                #a second new ISBN with the same title in this delivery is rejected too
+            rows.append((isbn, title, key, author, qty))
+        db.executemany('''
+        INSERT INTO authors(Name) VALUES(?) ON CONFLICT(Name) DO NOTHING
+        ''', [(row[3],) for row in rows if row[0] not in known])
+        db.executemany('''
+        INSERT INTO books(isbn, Title, title_key, author_id, Qty)
+        VALUES(?, ?, ?, (SELECT id FROM authors WHERE Name = ?), ?)
+        ON CONFLICT(isbn) WHERE isbn IS NOT NULL DO UPDATE SET Qty = Qty + excluded.Qty
+        ''', rows)
+        db.executemany('''
+        INSERT INTO stock_movements(book_id, kind, delta, note)
+        SELECT id, 'restock', ?, ? FROM books WHERE isbn = ?
+        ''', [(row[4], note, row[0]) for row in rows])
+    except Exception:
+        if commit:
+            db.rollback()
+        raise
+    if commit:
+        db.commit()
+    added = sum(1 for row in rows if row[0] not in known)
+    return Received(len(rows) - added, added, sum(row[4] for row in rows), unknown, rejected)
+
+
+#====Class Section====#
+class ScanBatch:
+    '''This class counts up the scans of one delivery in memory. Scanning an ISBN again only
+    adds to its count, so a pallet of one title is a single row when the delivery is applied.
+    titles holds the (title, author) given for ISBNs that may be new to the catalog'''
+
+    def __init__(self):
+        self.counts = Counter()
+        self.titles = {}
+        self.scans = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def scan(self, isbn, qty=1, title=None, author=None):
+        #This counts one scan and returns the ISBN-13 it was counted under
+        if qty <= 0:
+            raise ValueError('the quantity received must be more than 0')
+        isbn = normalise_isbn(isbn)
+        if title is not None:
+            if title.strip() == '' or author is None or author.strip() == '':
+                raise ValueError('a new book needs both a title and an author')
+            self.titles[isbn] = (title.strip(), author.strip())
+        self.counts[isbn] += qty
+        self.scans += 1
+        return isbn
+
+    def read(self, lines):
+        '''This function counts every scan in lines, such as an open scan file, and returns a
+        (line number, reason) for each line that could not be read. Blank lines are skipped'''
+        rejects = []
+        reader = csv.reader(lines)
+        for fields in reader:
+            fields = [field.strip() for field in fields]
+            if fields in ([], ['']):
+                continue
+            if len(fields) not in (1, 2, 4):
+                rejects.append((reader.line_num, 'expected an ISBN, a quantity, and a title and author for a new book'))
+                continue
+            try:
+                qty = int(fields[1]) if len(fields) > 1 and fields[1] != '' else 1
+            except ValueError:
+                rejects.append((reader.line_num, 'invalid quantity'))
+                continue
+            try:
+                self.scan(fields[0], qty, *fields[2:])
+            except ValueError as error:
+                rejects.append((reader.line_num, str(error)))
+        return rejects
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Receive a delivery from a file of scanned ISBNs.')
+    parser.add_argument('path', help='the scan file, or - to read the scans from stdin')
+    parser.add_argument('--database', default=DATABASE_PATH)
+    options = parser.parse_args(arguments)
+    batch = ScanBatch()
+    if options.path == '-':
+        rejects = batch.read(sys.stdin)
+    else:
+        with open(options.path, newline='', encoding='utf-8') as scan_file:
+            rejects = batch.read(scan_file)
+    for line_number, reason in rejects:
+        print(f"Line {line_number} was not read: {reason}")
+    db = open_connection(options.database)
+    result = receive(db, batch)
+    db.close()
+    for isbn in result.unknown:
+        print(f"ISBN {isbn} is not in the catalog, add it to the scan file with its title and author")
+    for isbn, reason in result.rejected:
+        print(f"ISBN {isbn} was not added: {reason}")
+    print(f"{result.units} books received from {batch.scans} scans, {result.restocked} titles restocked "
+        f"and {result.added} added")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''This module keeps a copy of the database in memory for the menu's searches and listings,
+so reads never compete with writers for the file on disk. The copy is made with the sqlite3
+backup API into a new in-memory database, which then takes the place of the old copy, so a
+refresh never blocks a read that is already running.
+
+A refresh only happens when the file has changed, which SQLite's data_version tells us
+without reading any books. The copy is refreshed at most once every refresh_interval
+seconds. The ReplicatedBookRepository counts the changes made on the clerk's own connection
+and sends the clerk's reads to the file on disk whenever the copy could be missing one of
+them, so the clerk always sees their own changes without a write ever costing a copy of the
+whole database. That includes writes waiting in group commit mode, however they are
+committed later.
+'''
+#====Module Section====#
+import sqlite3
+import threading
+import time
+
+from bookstore_connections import DATABASE_PATH, open_connection
+from bookstore_repository import BookRepository
+
+REFRESH_INTERVAL = 5.0
+#the most seconds a read can lag behind changes made by other clerks
+
+READS = ('count', 'get_by_id', 'get_many', 'find_by_title', 'find_by_isbn', 'find_by_author', 'find_by_qty', 'search',
+    'composite_search', 'composite_plan', 'similar_titles', 'all_books', 'page', 'low_stock', 'low_stock_count',
+    'top_by_qty', 'bottom_by_qty', 'author_totals')
+
+
+#====Class Section====#
+class ReadReplica:
+    '''This class holds the in-memory copy of one database file. The copy is read through
+    repository(), which refreshes it first when it is due. refreshes counts the copies made
+    and refresh_seconds the time they took'''
+
+    def __init__(self, path=DATABASE_PATH, refresh_interval=REFRESH_INTERVAL, clock=time.monotonic):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.source = open_connection(path, check_same_thread=False)
+        self.db = None
+        self.refreshes = 0
+        self.refresh_seconds = 0.0
+        self._version = None
+        self._refreshed = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def changed(self):
+        #data_version goes up whenever another connection commits to the file
+        return self.source.execute('PRAGMA data_version').fetchone()[0] != self._version
+
+    def refresh(self):
+        '''This function copies the database file into a new in-memory database and swaps it
+        in. It returns False without copying if the file has not changed'''
+        with self._lock:
+            if self.db is not None and not self.changed():
+                self._refreshed = self.clock()
+                return False
+            start = time.perf_counter()
+            version = self.source.execute('PRAGMA data_version').fetchone()[0]
+            copy = sqlite3.connect(':memory:', check_same_thread=False)
+            self.source.backup(copy)
+            self.db = copy
+            #the old copy is closed once the last repository reading it is finished with
+            self._version = version
+            self._refreshed = self.clock()
+            self.refreshes += 1
+            self.refresh_seconds += time.perf_counter() - start
+        return True
+
+    def due(self):
+        return self.clock() - self._refreshed >= self.refresh_interval
+
+    def repository(self):
+        #This returns a repository reading the copy, refreshing it first if it is due
+        if self.due():
+            self.refresh()
+        return BookRepository(self.db)
+
+    def close(self):
+        with self._lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            self.source.close()
+
+
+class ReplicatedBookRepository:
+    '''This class sends the lookups of a BookRepository to a ReadReplica and everything else
+    to the repository on disk. synced is the number of changes made on the disk connection
+    that the copy is known to hold, from its total_changes. While the connection has made
+    more changes than that, or has a transaction open, the lookups go to disk as well. A copy
+    only counts as holding the changes if no transaction was open when it was made, as the
+    writes in it could be committed afterwards by the group commit timer'''
+
+    def __init__(self, repo, replica):
+        self.repo = repo
+        self.replica = replica
+        self.synced = None if repo.db.in_transaction else repo.db.total_changes
+
+    def reader(self):
+        #This returns the repository the next lookup should read, refreshing the copy first if it is due
+        db = self.repo.db
+        changes, pending = db.total_changes, db.in_transaction
+        if self.replica.due():
+            self.replica.refresh()
+            if not pending:
+                self.synced = changes
+        if db.in_transaction or db.total_changes != self.synced:
+            return self.repo
+        return self.replica.repository()
+
+    def __getattr__(self, name):
+        if name in READS:
+            return getattr(self.reader(), name)
+        return getattr(self.repo, name)
+
+    def close(self):
+        self.repo.close()
+        self.replica.close()
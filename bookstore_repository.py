@@ -0,0 +1,516 @@
+'''This module holds all of the database access for the books table.
+The BookRepository class can be used from any other program or script without starting
+the interactive menu. Every method answers with a single query, and connections are opened
+with a larger statement cache so the repeated lookups reuse their compiled statements.
+'''
+#====Module Section====#
+import json
+from collections import Counter, namedtuple
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional
+
+from bookstore_connections import DATABASE_PATH, GroupCommit, GROUP_MAX_WRITES, GROUP_MAX_DELAY, open_connection
+from bookstore_ledger import record_movement, set_stock
+from bookstore_receiving import RECEIVE_NOTE, normalise_isbn, receive
+from bookstore_search import (fts_query, SEARCH_LIMIT, SIMILAR_LIMIT, SIMILARITY, COMMON_TRIGRAM, SIMILAR_CANDIDATES,
+    similarity, title_key, trigram_query, trigrams)
+
+PAGE_SIZE = 20
+
+Book = namedtuple('Book', ['id', 'Title', 'Author', 'Qty'])
+#Each book is returned as a Book so fields can be read by name or by position as before
+AuthorTotal = namedtuple('AuthorTotal', ['Author', 'books', 'total_qty', 'average_qty'])
+SEARCH_ORDERS = {'relevance': ('books_fts.rank',), 'id': ('books.id',), 'title': ('books.title_key',),
+    'qty': ('books.Qty', 'books.id')}
+#the columns each order of a composite search sorts on, titles sort by their key so case is ignored
+
+
+#====Function Section====#
+def connect(path=DATABASE_PATH, **options):
+    #This opens the database in WAL mode with the larger statement cache and an up to date schema
+    return open_connection(path, **options)
+
+def id_selection(text):
+    '''This function reads a list of IDs and ID ranges such as "3001, 3004, 3006-3010".
+    It returns a list of IDs and a list of (low, high) ranges, or None and None if any part
+    is not a number'''
+    ids = []
+    id_ranges = []
+    for part in text.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        low, dash, high = part.partition('-')
+        try:
+            if dash == '':
+                ids.append(int(low))
+            else:
+                id_ranges.append((min(int(low), int(high)), max(int(low), int(high))))
+        except ValueError:
+            return None, None
+    if ids == [] and id_ranges == []:
+        return None, None
+    return ids, id_ranges
+
+def author_id(db, name):
+    #This returns the id of the author with this name, adding the author first if they are new
+    db.execute('''
+    INSERT INTO authors(Name) VALUES(?) ON CONFLICT(Name) DO NOTHING
+    ''', (name,))
+    return db.execute('''
+    SELECT id FROM authors WHERE Name = ?
+    ''', (name,)).fetchone()[0]
+
+def insert_books(db, books):
+    '''This function inserts a list of (id, Title, Author, Qty) tuples. Any authors not in the
+    authors table yet are added first, then each book finds its author's id through the
+    unique index on the name. Each book is stored with its title key'''
+    books = list(books)
+    db.executemany('''
+    INSERT INTO authors(Name) VALUES(?) ON CONFLICT(Name) DO NOTHING
+    ''', [(book[2],) for book in books])
+    db.executemany('''
+    INSERT INTO books(id, Title, title_key, author_id, Qty)
+    VALUES(?, ?, ?, (SELECT id FROM authors WHERE Name = ?), ?)
+    ''', [(book_id, title, title_key(title), author, qty) for book_id, title, author, qty in books])
+
+
+#====Class Section====#
+class BookRepository:
+    '''This class reads and writes books through one sqlite3 connection.
+    Lookups return a Book, None or a list of Books. Writes are committed before the
+    method returns unless commit=False is passed to group several writes into one
+    transaction, or group commit mode is on. The unique Title rule raises
+    sqlite3.IntegrityError as usual'''
+
+    def __init__(self, db):
+        self.db = db
+        self.group = None
+
+    @classmethod
+    def open(cls, path=DATABASE_PATH, **options):
+        return cls(connect(path, **options))
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def _one(self, sql, parameters=()):
+        row = self.db.execute(sql, parameters).fetchone()
+        if row is None:
+            return None
+        return Book._make(row)
+
+    def _all(self, sql, parameters=()):
+        return [Book._make(row) for row in self.db.execute(sql, parameters)]
+
+    #====Lookups====#
+    def count(self) -> int:
+        return self.db.execute('''
+        SELECT COUNT(*) FROM books
+        ''').fetchone()[0]
+
+    def get_by_id(self, book_id: int) -> Optional[Book]:
+        return self._one('''
+        SELECT id, Title, Author, Qty FROM book_details WHERE id = ?
+        ''', (book_id,))
+
+    def get_many(self, book_ids: List[int]) -> List[Book]:
+        '''This looks up a whole list of ids in one query. The ids are passed as one JSON
+        array so there is no limit on how many can be asked for, and each is found through
+        the primary key. Ids with no book are left out'''
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details
+        WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id
+        ''', (json.dumps(list(book_ids)),))
+
+    def find_by_title(self, title: str) -> Optional[Book]:
+        '''This finds the book with the same title key, so case, punctuation and spacing are
+        ignored. It is what stops a title being added twice, with one probe of the unique index'''
+        return self._one('''
+        SELECT books.id, books.Title, authors.Name, books.Qty FROM books
+        JOIN authors ON authors.id = books.author_id WHERE books.title_key = ?
+        ''', (title_key(title),))
+
+    def find_by_isbn(self, isbn: str) -> Optional[Book]:
+        #Any ISBN-10 or ISBN-13 form of the number finds the book, ValueError is raised if it is not an ISBN
+        return self._one('''
+        SELECT books.id, books.Title, authors.Name, books.Qty FROM books
+        JOIN authors ON authors.id = books.author_id WHERE books.isbn = ?
+        ''', (normalise_isbn(isbn),))
+
+    def similar_titles(self, title: str, limit: int = SIMILAR_LIMIT, threshold: float = SIMILARITY) -> List[Book]:
+        '''This returns the books whose titles are nearly the same as title, most alike first,
+        such as a misspelling or a missing word. Each trigram of the title key is looked up in
+        the trigram index, skipping any found in more than COMMON_TRIGRAM titles, and the
+        books sharing the most of the rest are compared on all of their trigrams. If every
+        trigram is common the books having all of them are compared instead'''
+        wanted = trigrams(title_key(title))
+        if wanted == set():
+            return []
+        shared = Counter()
+        common = []
+        for trigram in sorted(wanted):
+            rows = self.db.execute('''
+            SELECT rowid FROM books_trigram WHERE books_trigram MATCH ? LIMIT ?
+            ''', (trigram_query([trigram]), COMMON_TRIGRAM + 1)).fetchall()
+            if len(rows) > COMMON_TRIGRAM:
+                common.append(trigram)
+            else:
+                shared.update(row[0] for row in rows)
+        if shared:
+            ids = [book_id for book_id, count in shared.most_common(SIMILAR_CANDIDATES)]
+        elif common == []:
+            return []
+        else:
+            ids = [row[0] for row in self.db.execute('''
+            SELECT rowid FROM books_trigram WHERE books_trigram MATCH ? LIMIT ?
+            ''', (trigram_query(common, ' AND '), SIMILAR_CANDIDATES))]
+        keys = self.db.execute('''
+        SELECT id, title_key FROM books WHERE id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(ids),)).fetchall()
+        scored = sorted(((similarity(wanted, trigrams(key)), book_id) for book_id, key in keys), reverse=True)
+        ids = [book_id for score, book_id in scored if score >= threshold][:limit]
+        books = {book.id: book for book in self.get_many(ids)}
+        return [books[book_id] for book_id in ids]
+
+    def find_by_author(self, author: str) -> List[Book]:
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details WHERE Author = ? ORDER BY id
+        ''', (author,))
+
+    def find_by_qty(self, qty: int) -> List[Book]:
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details WHERE Qty = ? ORDER BY id
+        ''', (qty,))
+
+    def search(self, text: str, column: Optional[str] = None, limit: int = SEARCH_LIMIT) -> List[Book]:
+        '''This is the full-text search, column may be 'Title' or 'Author' to only search one
+        of them. The best matches come first'''
+        query = fts_query(text, column)
+        if query is None:
+            return []
+        return self._all('''
+        SELECT book_details.id, book_details.Title, book_details.Author, book_details.Qty FROM books_fts
+        JOIN book_details ON book_details.id = books_fts.rowid
+        WHERE books_fts MATCH ?
+        ORDER BY books_fts.rank
+        LIMIT ?
+        ''', (query, limit))
+
+    def _composite(self, title, author, id_range, qty_range, order, descending, limit):
+        '''This compiles a composite search into one parameterized statement and its values.
+        The words of the title and author become one full-text query so both are answered
+        from the FTS index together, and each range becomes a comparison that an index or
+        the primary key can answer. Only the values ever come from the caller, every piece
+        of SQL is picked from a fixed set'''
+        clauses = []
+        values = []
+        words = [query for query in (fts_query(title or '', 'Title'), fts_query(author or '', 'Author')) if query is not None]
+        if words != []:
+            clauses.append('books_fts MATCH ?')
+            values.append(' AND '.join(words))
+        for column, (low, high) in (('books.id', id_range or (None, None)), ('books.Qty', qty_range or (None, None))):
+            if low is not None and high is not None:
+                clauses.append(f'{column} BETWEEN ? AND ?')
+                values.extend((low, high))
+            elif low is not None:
+                clauses.append(f'{column} >= ?')
+                values.append(low)
+            elif high is not None:
+                clauses.append(f'{column} <= ?')
+                values.append(high)
+        if order is None:
+            order = 'relevance' if words != [] else 'id'
+        if order not in SEARCH_ORDERS:
+            raise ValueError(f"order must be one of {', '.join(SEARCH_ORDERS)}")
+        if order == 'relevance' and words == []:
+            raise ValueError('only a search for title or author words can be ordered by relevance')
+        direction = ' DESC' if descending else ''
+        source = 'books_fts JOIN books ON books.id = books_fts.rowid' if words != [] else 'books'
+        where = 'WHERE ' + ' AND '.join(clauses) if clauses != [] else ''
+        #authors never filter the books, a CROSS JOIN keeps SQLite from reading every book through the author index
+        sql = f'''
+        SELECT books.id, books.Title, authors.Name, books.Qty FROM {source}
+        CROSS JOIN authors ON authors.id = books.author_id
+        {where}
+        ORDER BY {', '.join(column + direction for column in SEARCH_ORDERS[order])}
+        LIMIT ?
+        '''
+        return sql, (*values, limit)
+
+    def composite_search(self, title: Optional[str] = None, author: Optional[str] = None, id_range: Optional[tuple] = None,
+            qty_range: Optional[tuple] = None, order: Optional[str] = None, descending: bool = False,
+            limit: int = SEARCH_LIMIT) -> List[Book]:
+        '''This finds the books matching every filter given, in one query. title and author
+        match the start of each word like search(), and id_range and qty_range are (low, high)
+        pairs where either end can be None to leave it open. order is one of SEARCH_ORDERS,
+        the best matches first when words are given and id order otherwise'''
+        return self._all(*self._composite(title, author, id_range, qty_range, order, descending, limit))
+
+    def composite_plan(self, title: Optional[str] = None, author: Optional[str] = None, id_range: Optional[tuple] = None,
+            qty_range: Optional[tuple] = None, order: Optional[str] = None, descending: bool = False,
+            limit: int = SEARCH_LIMIT) -> List[str]:
+        #This returns SQLite's EXPLAIN QUERY PLAN for a composite search, one line for each step
+        sql, values = self._composite(title, author, id_range, qty_range, order, descending, limit)
+        return [row[3] for row in self.db.execute('EXPLAIN QUERY PLAN ' + sql, values)]
+
+    def all_books(self):
+        '''This generator yields every book in id order. The rows are streamed from the cursor
+        rather than built into a list, so only one book at a time is held in memory'''
+        for row in self.db.execute('''
+        SELECT id, Title, Author, Qty FROM book_details ORDER BY id
+        '''):
+            yield Book._make(row)
+
+    def page(self, after_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = PAGE_SIZE) -> List[Book]:
+        '''This returns one page of books in id order, starting after after_id or ending
+        before before_id. Each page starts from an id rather than an OFFSET so the primary
+        key finds it straight away however far through the table it is'''
+        if before_id is not None:
+            #the previous page is read backwards from the first id shown then put back in order
+            return self._all('''
+            SELECT id, Title, Author, Qty FROM book_details WHERE id < ? ORDER BY id DESC LIMIT ?
+            ''', (before_id, limit))[::-1]
+        if after_id is not None:
+            return self._all('''
+            SELECT id, Title, Author, Qty FROM book_details WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after_id, limit))
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details ORDER BY id LIMIT ?
+        ''', (limit,))
+
+    #====Reports====#
+    def low_stock(self, below: int, limit: Optional[int] = None) -> List[Book]:
+        #This returns the books with fewer than below in stock, lowest first, read along the Qty index
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details WHERE Qty < ? ORDER BY Qty, id LIMIT ?
+        ''', (below, -1 if limit is None else limit))
+
+    def low_stock_count(self, below: int) -> int:
+        return self.db.execute('''
+        SELECT COUNT(*) FROM books WHERE Qty < ?
+        ''', (below,)).fetchone()[0]
+
+    def top_by_qty(self, count: int) -> List[Book]:
+        #The Qty index is read from its highest end so only count books are ever visited
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details ORDER BY Qty DESC LIMIT ?
+        ''', (count,))
+
+    def bottom_by_qty(self, count: int) -> List[Book]:
+        return self._all('''
+        SELECT id, Title, Author, Qty FROM book_details ORDER BY Qty LIMIT ?
+        ''', (count,))
+
+    def author_totals(self, author: Optional[str] = None, limit: Optional[int] = None) -> List[AuthorTotal]:
+        '''This returns each author's number of books and total and average stock, most stock
+        first, or just the one author if one is given. The sums are worked out by SQLite from
+        the index on (author_id, Qty) without reading the books themselves, and each author's
+        name is looked up once'''
+        if author is not None:
+            return [AuthorTotal._make(row) for row in self.db.execute('''
+            SELECT authors.Name, COUNT(*), SUM(books.Qty), AVG(books.Qty)
+            FROM authors JOIN books ON books.author_id = authors.id
+            WHERE authors.Name = ? GROUP BY authors.id
+            ''', (author,))]
+        return [AuthorTotal._make(row) for row in self.db.execute('''
+        SELECT authors.Name, totals.books, totals.total_qty, totals.average_qty
+        FROM (SELECT author_id, COUNT(*) AS books, SUM(Qty) AS total_qty, AVG(Qty) AS average_qty
+            FROM books GROUP BY author_id) AS totals
+        JOIN authors ON authors.id = totals.author_id
+        ORDER BY totals.total_qty DESC, authors.Name LIMIT ?
+        ''', (-1 if limit is None else limit,))]
+
+    #====Writes====#
+    @contextmanager
+    def _writing(self, commit):
+        '''Every write runs inside this. A finished write is committed, unless commit is False
+        because the caller is grouping several writes into one transaction, and a failed
+        write is rolled back. In group commit mode the write is counted towards the group
+        instead of being committed, and the group's lock is held so its timer can never
+        commit half of a write. Each write is wrapped in a savepoint, so one that fails part
+        way leaves nothing behind even when the transaction around it is committed later'''
+        lock = self.group.lock if self.group is not None else nullcontext()
+        with lock:
+            if not self.db.in_transaction:
+                self.db.execute('BEGIN IMMEDIATE')
+                #a savepoint outside a transaction would commit as soon as it is released, and the
+                #write lock is taken before anything is read so a read-then-write step stays exact
+            self.db.execute('SAVEPOINT write')
+            try:
+                yield
+            except Exception:
+                if self.db.in_transaction:
+                    self.db.execute('ROLLBACK TO write')
+                    self.db.execute('RELEASE write')
+                if commit and self.group is None and self.db.in_transaction:
+                    self.db.rollback()
+                raise
+            self.db.execute('RELEASE write')
+            if commit and self.group is not None:
+                self.group.wrote()
+            elif commit:
+                self.db.commit()
+
+    def start_group_commit(self, max_writes=GROUP_MAX_WRITES, max_delay=GROUP_MAX_DELAY, synchronous=None):
+        '''This turns on group commit mode for this repository, see GroupCommit. The connection
+        must have been opened with check_same_thread=False so the timer can commit'''
+        self.group = GroupCommit(self.db, max_writes, max_delay, synchronous)
+        return self.group
+
+    def flush(self):
+        #This commits any writes waiting in group commit mode, it does nothing otherwise
+        if self.group is not None:
+            self.group.flush()
+
+    def add(self, title: str, author: str, qty: int, book_id: Optional[int] = None, isbn: Optional[str] = None,
+            commit: bool = True) -> int:
+        #The new book's id is returned, it is auto assigned unless one is given
+        if isbn is not None:
+            isbn = normalise_isbn(isbn)
+        with self._writing(commit):
+            cursor = self.db.execute('''
+            INSERT INTO books(id, Title, title_key, author_id, Qty, isbn) VALUES(?,?,?,?,?,?)
+            ''', (book_id, title, title_key(title), author_id(self.db, author), qty, isbn))
+        return cursor.lastrowid
+
+    def add_many(self, books, commit: bool = True) -> None:
+        #books is a list of (id, Title, Author, Qty) tuples, they are added in one transaction
+        with self._writing(commit):
+            insert_books(self.db, books)
+
+    def update(self, book_id: int, title: Optional[str] = None, author: Optional[str] = None, qty: Optional[int] = None,
+            isbn: Optional[str] = None, commit: bool = True) -> bool:
+        '''This changes whichever of the title, author, quantity and ISBN are given. It returns
+        False if there is no book with that id. A new quantity is recorded in the stock
+        ledger as an adjustment'''
+        changes = []
+        values = []
+        if title is not None:
+            changes.append('Title = ?, title_key = ?')
+            values.extend((title, title_key(title)))
+        if isbn is not None:
+            changes.append('isbn = ?')
+            values.append(normalise_isbn(isbn))
+        if author is not None:
+            changes.append('author_id = ?')
+            values.append(author)
+        with self._writing(commit):
+            if author is not None:
+                values[-1] = author_id(self.db, author)
+            if changes == []:
+                found = self.get_by_id(book_id) is not None
+            else:
+                cursor = self.db.execute(f'''
+                UPDATE books SET {', '.join(changes)} WHERE id = ?
+                ''', (*values, book_id))
+                found = cursor.rowcount > 0
+            if found and qty is not None:
+                set_stock(self.db, book_id, qty, commit=False)
+        return found
+
+    def adjust_stock(self, book_id: int, delta: int, kind: str, note: Optional[str] = None, commit: bool = True) -> int:
+        '''This records a sale (a negative delta), restock or adjustment in the stock ledger
+        and returns the new quantity. It raises StockError if the book does not exist or
+        the stock would go below zero'''
+        with self._writing(commit):
+            qty = record_movement(self.db, book_id, kind, delta, note, commit=False)
+        return qty
+
+    def set_stock(self, book_id: int, qty: int, note: Optional[str] = None, commit: bool = True) -> int:
+        #This sets the stock to a counted quantity, recording the difference as an adjustment
+        with self._writing(commit):
+            qty = set_stock(self.db, book_id, qty, note, commit=False)
+        return qty
+
+    def receive(self, batch, note: str = RECEIVE_NOTE, commit: bool = True):
+        '''This applies a delivery counted up in a ScanBatch with one batched upsert and
+        returns a Received, see bookstore_receiving.receive'''
+        with self._writing(commit):
+            result = receive(self.db, batch, note, commit=False)
+        return result
+
+    def import_books(self, path: str):
+        '''This imports a CSV or JSONL catalog and returns an ImportResult, see
+        bookstore_transfer.import_file. The import commits its own chunks, so any writes
+        waiting in group commit mode are committed first'''
+        from bookstore_transfer import import_file
+        #bookstore_transfer imports this module, so it is only imported when it is needed
+        self.flush()
+        return import_file(self.db, path)
+
+    def delete_where(self, ids: Optional[List[int]] = None, id_ranges: Optional[List[tuple]] = None, qty: Optional[int] = None,
+            qty_below: Optional[int] = None, author: Optional[str] = None, dry_run: bool = False, commit: bool = True) -> int:
+        '''This deletes every book matching the filters with one DELETE statement and returns
+        how many books it deleted. A book is matched if its id is in ids or inside one of the
+        (low, high) id_ranges, and it also has the quantity qty, a quantity below qty_below
+        and the author given. Each filter is answered from an index. With dry_run nothing is
+        deleted and the number of books that would be is returned. At least one filter must be
+        given so the whole table can never be deleted by mistake'''
+        id_clauses = []
+        clauses = []
+        values = []
+        if ids:
+            id_clauses.append('id IN (SELECT value FROM json_each(?))')
+            values.append(json.dumps(list(ids)))
+        for low, high in id_ranges or []:
+            id_clauses.append('id BETWEEN ? AND ?')
+            values.extend((low, high))
+        if id_clauses != []:
+            clauses.append('(' + ' OR '.join(id_clauses) + ')')
+        for clause, value in (('Qty = ?', qty), ('Qty < ?', qty_below),
+                ('author_id = (SELECT id FROM authors WHERE Name = ?)', author)):
+            if value is not None:
+                clauses.append(clause)
+                values.append(value)
+        if clauses == []:
+            raise ValueError('at least one filter is needed to delete books')
+        where = ' AND '.join(clauses)
+        if dry_run:
+            return self.db.execute(f'''
+            SELECT COUNT(*) FROM books WHERE {where}
+            ''', values).fetchone()[0]
+        with self._writing(commit):
+            cursor = self.db.execute(f'''
+            DELETE FROM books WHERE {where}
+            ''', values)
+        return cursor.rowcount
+
+    def rename_author(self, old_name: str, new_name: str, commit: bool = True) -> int:
+        '''This renames an author on every one of their books at once and returns how many
+        books they have. If the new name is already an author the two are merged, the books
+        moving over to the existing author. It returns 0 if there is no author called old_name'''
+        with self._writing(commit):
+            row = self.db.execute('''
+            SELECT id FROM authors WHERE Name = ?
+            ''', (old_name,)).fetchone()
+            if row is None:
+                return 0
+            old_id = row[0]
+            books = self.db.execute('''
+            SELECT COUNT(*) FROM books WHERE author_id = ?
+            ''', (old_id,)).fetchone()[0]
+            row = self.db.execute('''
+            SELECT id FROM authors WHERE Name = ?
+            ''', (new_name,)).fetchone()
+            if row is None:
+                self.db.execute('''
+                UPDATE authors SET Name = ? WHERE id = ?
+                ''', (new_name, old_id))
+            elif row[0] != old_id:
+                self.db.execute('''
+                UPDATE books SET author_id = ? WHERE author_id = ?
+                ''', (row[0], old_id))
+                self.db.execute('''
+                DELETE FROM authors WHERE id = ?
+                ''', (old_id,))
+        return books
+
+    def delete(self, book_id: int, commit: bool = True) -> bool:
+        #It returns False if there was no book with that id to delete
+        with self._writing(commit):
+            cursor = self.db.execute('''
+            DELETE FROM books WHERE id = ?
+            ''', (book_id,))
+        return cursor.rowcount > 0
@@ -0,0 +1,362 @@
+'''This module keeps the layout of the bookstore database up to date.
+Every change to the tables is written as a numbered migration. When the program starts
+any migrations that have not been applied to the database file yet are run in order,
+so an existing ebookstore file is upgraded in place without losing any books.
+'''
+#====Module Section====#
+import sqlite3
+
+from bookstore_search import title_key
+
+KEY_CHUNK_SIZE = 10000
+#books given their title key in each step of migration 7
+
+
+#====Migration Section====#
+def _create_books(cursor):
+    #The original table, IF NOT EXISTS keeps this safe for files made before migrations existed
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS
+    books(id INTEGER PRIMARY KEY,Title TEXT UNIQUE NOT NULL, Author TEXT NOT NULL,
+    Qty INTEGER NOT NULL)
+    ''')
+
+def _index_author_qty(cursor):
+    #Author and Qty searches would otherwise scan every row of the table
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_books_author ON books(Author)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_books_qty ON books(Qty)
+    ''')
+
+def _full_text_index(cursor):
+    '''The FTS5 table stores no copy of the books, it reads Title and Author from the books
+    table. The triggers keep the index in step with every insert, update and delete and the
+    rebuild indexes the books already in the file. Prefix indexes on the first two and three
+    characters keep short prefix searches quick on a large catalog'''
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(Title, Author,
+    content='books', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, Title, Author) VALUES(new.id, new.Title, new.Author);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, Title, Author) VALUES('delete', old.id, old.Title, old.Author);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF id, Title, Author ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, Title, Author) VALUES('delete', old.id, old.Title, old.Author);
+        INSERT INTO books_fts(rowid, Title, Author) VALUES(new.id, new.Title, new.Author);
+    END
+    ''')
+    cursor.execute('''
+    INSERT INTO books_fts(books_fts) VALUES('rebuild')
+    ''')
+
+def _stock_ledger(cursor):
+    '''Every change to a book's stock is recorded as a movement. Old movements are folded
+    into one snapshot row per book by compaction, so the ledger does not grow forever.
+    books.Qty stays the current stock so reading it never needs the ledger. AUTOINCREMENT
+    stops ids being reused once compaction has emptied the table, as snapshots refer to them'''
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS
+    stock_movements(id INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('sale', 'restock', 'adjustment')),
+    delta INTEGER NOT NULL, note TEXT,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_stock_movements_book ON stock_movements(book_id, id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_stock_movements_created ON stock_movements(created_at)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS
+    stock_snapshots(book_id INTEGER PRIMARY KEY, qty INTEGER NOT NULL,
+    movement_id INTEGER NOT NULL, taken_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)
+    ''')
+
+def _author_qty_index(cursor):
+    '''The stock reports group by author and add up Qty. With both columns in one index the
+    totals are read from the index alone without visiting the books. It also answers every
+    Author lookup the old single column index did, so that index is dropped'''
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_books_author_qty ON books(Author, Qty)
+    ''')
+    cursor.execute('''
+    DROP INDEX IF EXISTS idx_books_author
+    ''')
+
+def _authors_table(cursor):
+    '''Each author's name is stored once in the authors table and books refer to it by id,
+    so the name is not repeated on every book and renaming an author changes one row.
+    SQLite cannot change a column into a reference, so books is built again with author_id
+    in place of Author and the old table dropped, which also drops its indexes and triggers.
+    The book_details view joins the name back on for reading. The full-text index now reads
+    from the view, so it is made again and its triggers look the author's name up, with a
+    trigger on authors keeping a renamed author's books searchable under the new name'''
+    cursor.execute('''
+    CREATE TABLE authors(id INTEGER PRIMARY KEY, Name TEXT UNIQUE NOT NULL)
+    ''')
+    cursor.execute('''
+    INSERT INTO authors(Name) SELECT DISTINCT Author FROM books ORDER BY Author
+    ''')
+    cursor.execute('''
+    CREATE TABLE books_new(id INTEGER PRIMARY KEY, Title TEXT UNIQUE NOT NULL,
+    author_id INTEGER NOT NULL REFERENCES authors(id), Qty INTEGER NOT NULL)
+    ''')
+    cursor.execute('''
+    INSERT INTO books_new(id, Title, author_id, Qty)
+    SELECT books.id, books.Title, authors.id, books.Qty FROM books JOIN authors ON authors.Name = books.Author
+    ''')
+    cursor.execute('''
+    DROP TABLE books_fts
+    ''')
+    cursor.execute('''
+    DROP TABLE books
+    ''')
+    cursor.execute('''
+    ALTER TABLE books_new RENAME TO books
+    ''')
+    cursor.execute('''
+    CREATE INDEX idx_books_qty ON books(Qty)
+    ''')
+    cursor.execute('''
+    CREATE INDEX idx_books_author_qty ON books(author_id, Qty)
+    ''')
+    cursor.execute('''
+    CREATE VIEW book_details AS
+    SELECT books.id AS id, books.Title AS Title, authors.Name AS Author, books.Qty AS Qty
+    FROM books JOIN authors ON authors.id = books.author_id
+    ''')
+    cursor.execute('''
+    CREATE VIRTUAL TABLE books_fts USING fts5(Title, Author,
+    content='book_details', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, Title, Author)
+        VALUES(new.id, new.Title, (SELECT Name FROM authors WHERE id = new.author_id));
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, Title, Author)
+        VALUES('delete', old.id, old.Title, (SELECT Name FROM authors WHERE id = old.author_id));
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER books_fts_update AFTER UPDATE OF id, Title, author_id ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, Title, Author)
+        VALUES('delete', old.id, old.Title, (SELECT Name FROM authors WHERE id = old.author_id));
+        INSERT INTO books_fts(rowid, Title, Author)
+        VALUES(new.id, new.Title, (SELECT Name FROM authors WHERE id = new.author_id));
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER authors_fts_rename AFTER UPDATE OF Name ON authors BEGIN
+        INSERT INTO books_fts(books_fts, rowid, Title, Author)
+        SELECT 'delete', id, Title, old.Name FROM books WHERE author_id = old.id;
+        INSERT INTO books_fts(rowid, Title, Author)
+        SELECT id, Title, new.Name FROM books WHERE author_id = new.id;
+    END
+    ''')
+    cursor.execute('''
+    INSERT INTO books_fts(books_fts) VALUES('rebuild')
+    ''')
+
+def _title_keys(cursor):
+    '''Each book gets a title key, its title casefolded with punctuation and spacing
+    collapsed, under a unique index so a duplicate is found with one index probe. The key is
+    worked out in Python as SQLite has no Unicode casefolding. Books already in the file
+    whose titles only differ in those ways get their id added to the key, so the index can
+    be made and both books are kept, and they show up as near duplicates of each other.
+    A trigram FTS5 index on the key finds titles that are nearly the same'''
+    cursor.execute('''
+    ALTER TABLE books ADD COLUMN title_key TEXT NOT NULL DEFAULT ''
+    ''')
+    reader = cursor.connection.execute('''
+    SELECT id, Title FROM books ORDER BY id
+    ''')
+    seen = set()
+    while True:
+        rows = reader.fetchmany(KEY_CHUNK_SIZE)
+        if rows == []:
+            break
+        keys = []
+        for book_id, title in rows:
+            key = title_key(title)
+            if key in seen:
+                key = f'{key} #{book_id}'
+                #a # is never left in a title key so this cannot match another title
+            seen.add(key)
+            keys.append((key, book_id))
+        cursor.executemany('''
+        UPDATE books SET title_key = ? WHERE id = ?
+        ''', keys)
+    cursor.execute('''
+    CREATE UNIQUE INDEX idx_books_title_key ON books(title_key)
+    ''')
+    cursor.execute('''
+    CREATE VIRTUAL TABLE books_trigram USING fts5(title_key,
+    content='books', content_rowid='id', tokenize='trigram', detail='none')
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER books_trigram_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_trigram(rowid, title_key) VALUES(new.id, new.title_key);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER books_trigram_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_trigram(books_trigram, rowid, title_key) VALUES('delete', old.id, old.title_key);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER books_trigram_update AFTER UPDATE OF id, title_key ON books BEGIN
+        INSERT INTO books_trigram(books_trigram, rowid, title_key) VALUES('delete', old.id, old.title_key);
+        INSERT INTO books_trigram(rowid, title_key) VALUES(new.id, new.title_key);
+    END
+    ''')
+    cursor.execute('''
+    INSERT INTO books_trigram(books_trigram) VALUES('rebuild')
+    ''')
+
+def _isbn_column(cursor):
+    '''Books get an ISBN so a delivery can be received by scanning barcodes. Books already in
+    the file have none, so the unique index only covers books that have one, which also
+    keeps it small while most of the catalog is still without. The ISBN is stored as the 13
+    digits of ISBN-13, see bookstore_receiving.normalise_isbn'''
+    cursor.execute('''
+    ALTER TABLE books ADD COLUMN isbn TEXT
+    ''')
+    cursor.execute('''
+    CREATE UNIQUE INDEX idx_books_isbn ON books(isbn) WHERE isbn IS NOT NULL
+    ''')
+
+def _change_log(cursor):
+    '''Every insert, update and delete of a book is written to book_changes by a trigger, so
+    a mirror of the catalog can catch up by reading only what changed since it last looked.
+    seq is the order the changes were committed in, as SQLite has one writer at a time, and
+    AUTOINCREMENT means a seq is never given out twice, even after old changes are pruned.
+    Renaming an author changes every one of their books as they are read, so the rename is
+    logged as an update of each book. change_consumers remembers how far each mirror has read,
+    which is how far the log can be pruned'''
+    cursor.execute('''
+    CREATE TABLE book_changes(seq INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER NOT NULL,
+    operation TEXT NOT NULL CHECK (operation IN ('insert', 'update', 'delete')),
+    changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    cursor.execute('''
+    CREATE TABLE change_consumers(name TEXT PRIMARY KEY, seq INTEGER NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER book_changes_insert AFTER INSERT ON books BEGIN
+        INSERT INTO book_changes(book_id, operation) VALUES(new.id, 'insert');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER book_changes_update AFTER UPDATE OF Title, author_id, Qty, isbn ON books
+    WHEN old.Title IS NOT new.Title OR old.author_id IS NOT new.author_id OR old.Qty IS NOT new.Qty
+        OR old.isbn IS NOT new.isbn
+    BEGIN
+        INSERT INTO book_changes(book_id, operation) VALUES(new.id, 'update');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER book_changes_delete AFTER DELETE ON books BEGIN
+        INSERT INTO book_changes(book_id, operation) VALUES(old.id, 'delete');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER book_changes_author AFTER UPDATE OF Name ON authors BEGIN
+        INSERT INTO book_changes(book_id, operation) SELECT id, 'update' FROM books WHERE author_id = new.id;
+    END
+    ''')
+
+def _incremental_vacuum(cursor):
+    '''With auto_vacuum set to INCREMENTAL the free pages left by deletes can be handed back
+    to the file system a few at a time by bookstore_maintenance, without rebuilding the whole
+    file. An existing file only takes the new setting when it is rebuilt by VACUUM, which
+    cannot run inside a transaction, so migrate() runs it after this migration, and again on
+    every open until the file really is INCREMENTAL in case that VACUUM failed'''
+    cursor.execute('''
+    PRAGMA auto_vacuum = INCREMENTAL
+    ''')
+
+#Each migration is (version, description, function). New migrations are only ever appended,
+#an applied migration must never be edited as existing files will not run it again
+MIGRATIONS = [
+    (1, 'create books table', _create_books),
+    (2, 'index books by author and quantity', _index_author_qty),
+    (3, 'full-text index on title and author', _full_text_index),
+    (4, 'stock movement ledger and snapshots', _stock_ledger),
+    (5, 'covering index on author and quantity for stock reports', _author_qty_index),
+    (6, 'authors table referenced by books', _authors_table),
+    (7, 'unique title key and trigram index for duplicate titles', _title_keys),
+    (8, 'unique ISBN for receiving deliveries by barcode', _isbn_column),
+    (9, 'change log of every book insert, update and delete', _change_log),
+    (10, 'incremental vacuum of free pages', _incremental_vacuum),
+]
+VACUUM_AFTER = {10: ('auto_vacuum', 2)}
+#the migrations that only take effect once the file is rebuilt by VACUUM, with the pragma
+#and the value it has once they have, 2 being INCREMENTAL
+
+
+#====Function Section====#
+def schema_version(db):
+    #The highest applied migration is the version of the database file
+    row = db.execute('''
+    SELECT COALESCE(MAX(version), 0) FROM schema_migrations
+    ''').fetchone()
+    return row[0]
+
+def migrate(db):
+    '''This function brings the database up to the latest version. The version table is
+    created first, then each missing migration runs in its own transaction together with
+    the row recording it, so a failed step leaves the file at the previous version.
+    The write lock is taken before the version is checked again, which stops two clerks
+    starting the program at the same time from applying the same migration twice.'''
+    db.execute('''
+    CREATE TABLE IF NOT EXISTS
+    schema_migrations(version INTEGER PRIMARY KEY, description TEXT NOT NULL,
+    applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    db.commit()
+    current = schema_version(db)
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(db) < version:
+                step(db.cursor())
+                db.execute('''
+                INSERT INTO schema_migrations(version, description) VALUES(?,?)
+                ''', (version, description))
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        current = version
+    rebuild(db, current)
+    return current
+
+def rebuild(db, current):
+    '''This function runs the VACUUM that the migrations in VACUUM_AFTER need, if the file has
+    not been rebuilt since they were applied. It is checked on every open, so a VACUUM that
+    failed (a busy timeout or a full disk) is tried again the next time rather than leaving
+    the file without the setting for good'''
+    for version, (pragma, value) in VACUUM_AFTER.items():
+        if current < version or db.execute(f'PRAGMA {pragma}').fetchone()[0] == value:
+            continue
+        db.execute(f'PRAGMA {pragma} = {value}')
+        #a setting like auto_vacuum is only kept on this connection until the next VACUUM
+        db.execute('VACUUM')
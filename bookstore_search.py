@@ -0,0 +1,63 @@
+'''This module provides the full-text search over book titles and authors.
+The books_fts table is an SQLite FTS5 index kept in step with the books table by triggers
+(see bookstore_schema). Searches ignore case and accents, match the start of each word typed,
+need every word to be present and return the best matches first.
+
+It also works out the title key used to spot duplicate titles, and the trigrams used to find
+titles that are nearly the same (see BookRepository.similar_titles).
+'''
+#====Module Section====#
+import re
+
+SEARCH_LIMIT = 50
+#This is the most results a single search will return
+
+SIMILAR_LIMIT = 5
+#the most near duplicates suggested for a title
+SIMILARITY = 0.5
+#the share of trigrams two title keys must have in common to count as near duplicates
+COMMON_TRIGRAM = 5000
+#a trigram in more titles than this, like "the", is too common to pick out near duplicates with
+SIMILAR_CANDIDATES = 100
+#the most titles compared in full for each near duplicate check
+
+WORD = re.compile(r'\w+')
+PUNCTUATION = re.compile(r'[\W_]+')
+
+
+#====Function Section====#
+def fts_query(text, column=None):
+    '''This function turns what the clerk typed into an FTS5 query. Each word is quoted so
+    punctuation can never be read as query syntax, and given a * so it matches as a prefix.
+    If a column is given the words must all be found in that column.
+    None is returned when there are no words to search for'''
+    words = WORD.findall(text)
+    if words == []:
+        return None
+    query = ' '.join(f'"{word}"*' for word in words)
+    if column is not None:
+        query = f'{column} : ({query})'
+    return query
+
+def title_key(title):
+    '''This function gives the key two titles share when they only differ in case,
+    punctuation or spacing, so "The Lord of the Rings" and "the lord of the rings!" are the
+    same book. A title with nothing but punctuation is only casefolded'''
+    key = PUNCTUATION.sub(' ', title.casefold()).strip()
+    if key == '':
+        return title.casefold().strip()
+    return key
+
+def trigrams(key):
+    #This returns every run of three characters in a title key
+    return {key[start:start + 3] for start in range(len(key) - 2)}
+
+def similarity(first, second):
+    #This is the share of the two sets of trigrams that they have in common, from 0 to 1
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+def trigram_query(terms, operator=' OR '):
+    #This quotes each trigram for the trigram index, joined by OR unless another operator is given
+    return operator.join('"' + term.replace('"', '""') + '"' for term in terms)
@@ -0,0 +1,398 @@
+'''This module serves the books table over HTTP with JSON so the website and the shop tills can
+check stock without going through the menu. It is built on asyncio so many requests can be
+waiting at once, while the SQLite calls themselves run on a bounded pool of worker threads,
+each with its own pooled connection. Nothing outside the standard library is needed.
+
+    python bookstore_service.py --port 8080
+    python bookstore_service.py --maintenance-every 3600 --backup "backups/shop-%H.db"
+
+    GET    /books?after=3010&limit=20     a page of books in id order
+    GET    /books?ids=3001,3004,3007      many books in one call
+    POST   /books/lookup {"ids": [...]}   the same for a long list of ids
+    GET    /books/3004                    one book
+    GET    /search?q=lord+ring&field=title full-text search, field is title or author
+    GET    /search?qty=0                  books with exactly this quantity
+    GET    /search?author=tara&max_qty=3&order=title   every filter at once, see below
+    POST   /books {"Title":..., "Author":..., "Qty":...}   add a book, or a list of books
+    PATCH  /books/3004 {"Qty": 12}        change any of Title, Author and Qty
+    DELETE /books/3004                    delete a book
+    POST   /books/3004/stock {"kind": "sale", "count": 2}   record a sale or restock in the ledger,
+                                          or {"qty": 12} to set a counted quantity
+    POST   /books/delete {"ids": [...], "id_ranges": [[low, high]], "qty": 0, "dry_run": true}
+                                          delete many books at once, or count them first
+    GET    /reports/low-stock?below=5     books with less than 5 in stock, lowest first
+    GET    /reports/top?n=10              the books with the most stock, /reports/bottom the least
+    GET    /reports/authors?limit=10      total and average stock per author, or ?author=name
+    GET    /stats/cache                   hit, miss and eviction counts of the lookup cache
+    GET    /changes?since=120&limit=500   the changes to books after seq 120, for keeping a mirror in step
+    POST   /changes/ack {"consumer": "website", "seq": 130}   record how far a mirror has read
+
+A search given any of title, author, min_id, max_id, min_qty, max_qty or order finds the books
+matching all of them in one query, sorted by order (relevance, id, title or qty) and reversed
+with desc=1.
+'''
+#====Module Section====#
+import argparse
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from bookstore_changes import ChangeLogError, CHANGE_LIMIT, acknowledge, changes_since, latest_change
+from bookstore_cache import CachedBookRepository, LRUCache, CACHE_SIZE, CACHE_TTL
+from bookstore_connections import ConnectionPool, DATABASE_PATH
+from bookstore_ledger import StockError
+from bookstore_maintenance import MaintenanceScheduler
+from bookstore_repository import BookRepository, PAGE_SIZE
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+WORKERS = 8
+#the most SQLite calls that run at the same time
+MAX_LIMIT = 500
+MAX_BODY = 10 * 1024 * 1024
+COMPOSITE_FILTERS = ('title', 'author', 'min_id', 'max_id', 'min_qty', 'max_qty', 'order')
+#a search given any of these is a composite search
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 409: 'Conflict', 410: 'Gone', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    #This is raised by a route to send an error status back with a message
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+#====Function Section====#
+def book_json(book):
+    return book._asdict()
+
+def integer(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f'{name} must be a whole number')
+
+def bounded(value, name, most=MAX_LIMIT):
+    #This reads a limit or count, SQLite takes a negative LIMIT as no limit so one below 1 is refused
+    number = integer(value, name)
+    if number < 1:
+        raise HTTPError(400, f'{name} must be at least 1')
+    return min(number, most)
+
+def book_fields(body, required):
+    '''This function checks the Title, Author and Qty sent for a new or changed book.
+    Keys are matched without caring about case'''
+    if not isinstance(body, dict):
+        raise HTTPError(400, 'a book must be a JSON object')
+    values = {str(key).lower(): value for key, value in body.items()}
+    title = values.get('title')
+    author = values.get('author')
+    qty = values.get('qty')
+    for name, value in (('Title', title), ('Author', author)):
+        if value is not None and (not isinstance(value, str) or value.strip() == ''):
+            raise HTTPError(400, f'{name} must be text')
+        if value is None and required:
+            raise HTTPError(400, f'{name} is required')
+    if qty is not None:
+        qty = integer(qty, 'Qty')
+        if qty < 0:
+            raise HTTPError(400, 'Qty cannot be negative')
+    elif required:
+        raise HTTPError(400, 'Qty is required')
+    return title, author, qty
+
+
+#====Class Section====#
+class BookService:
+    '''This class answers the HTTP requests. Each route works out what to do from the request
+    then hands the database work to the thread pool, so the event loop is never held up by
+    SQLite and can keep reading other requests'''
+
+    def __init__(self, path=DATABASE_PATH, workers=WORKERS, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
+        self.pool = ConnectionPool(path, max_idle=workers)
+        self.cache = LRUCache(cache_size, cache_ttl)
+        #the cache is shared by every worker thread
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bookstore-db')
+
+    async def database(self, work, write=False):
+        #This runs work(repo) on a worker thread with that thread's pooled connection
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.pool.run,
+            lambda db: work(CachedBookRepository(BookRepository(db), self.cache)), write)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    async def route(self, method, path, query, body):
+        '''This function picks the route for the request and returns the status and the
+        JSON value to send back'''
+        parts = [part for part in path.split('/') if part != '']
+        if parts == ['books'] and method == 'GET':
+            if 'ids' in query:
+                ids = [integer(book_id, 'ids') for book_id in ','.join(query['ids']).split(',') if book_id != '']
+                books = await self.database(lambda repo: repo.get_many(ids))
+                return 200, {'books': [book_json(book) for book in books]}
+            limit = bounded(query.get('limit', [PAGE_SIZE])[0], 'limit')
+            after = query.get('after', [None])[0]
+            before = query.get('before', [None])[0]
+            after = None if after is None else integer(after, 'after')
+            before = None if before is None else integer(before, 'before')
+            books = await self.database(lambda repo: repo.page(after, before, limit))
+            return 200, {'books': [book_json(book) for book in books]}
+        if parts == ['books', 'lookup'] and method == 'POST':
+            if not isinstance(body, dict) or not isinstance(body.get('ids'), list):
+                raise HTTPError(400, 'send {"ids": [...]}')
+            ids = [integer(book_id, 'ids') for book_id in body['ids']]
+            books = await self.database(lambda repo: repo.get_many(ids))
+            return 200, {'books': [book_json(book) for book in books]}
+        if parts == ['books', 'delete'] and method == 'POST':
+            if not isinstance(body, dict):
+                raise HTTPError(400, 'send the filters as a JSON object')
+            try:
+                ids = [integer(book_id, 'ids') for book_id in body.get('ids') or []]
+                id_ranges = [(integer(low, 'id_ranges'), integer(high, 'id_ranges')) for low, high in body.get('id_ranges') or []]
+            except (TypeError, ValueError):
+                raise HTTPError(400, 'id_ranges must be a list of [low, high] pairs')
+            book_filter = {'ids': ids, 'id_ranges': id_ranges, 'dry_run': bool(body.get('dry_run'))}
+            for name in ('qty', 'qty_below'):
+                if body.get(name) is not None:
+                    book_filter[name] = integer(body[name], name)
+            if body.get('author') is not None:
+                book_filter['author'] = str(body['author'])
+            def delete_books(repo):
+                try:
+                    return repo.delete_where(**book_filter)
+                except ValueError as error:
+                    raise HTTPError(400, str(error))
+            count = await self.database(delete_books, write=not book_filter['dry_run'])
+            return 200, {'matched' if book_filter['dry_run'] else 'deleted': count}
+        if parts == ['books'] and method == 'POST':
+            if isinstance(body, list):
+                new_books = [book_fields(book, True) for book in body]
+            else:
+                new_books = [book_fields(body, True)]
+            def add(repo):
+                #all the books are added in one transaction so a duplicate adds none of them
+                ids = []
+                for title, author, qty in new_books:
+                    ids.append(repo.add(title, author, qty, commit=False))
+                repo.db.commit()
+                return ids
+            ids = await self.database(add, write=True)
+            return 201, {'ids': ids}
+        if len(parts) == 3 and parts[0] == 'books' and parts[2] == 'stock' and method == 'POST':
+            book_id = integer(parts[1], 'id')
+            if not isinstance(body, dict):
+                raise HTTPError(400, 'send the stock change as a JSON object')
+            if body.get('qty') is not None:
+                qty = integer(body['qty'], 'qty')
+                work = lambda repo: repo.set_stock(book_id, qty, body.get('note'))
+            else:
+                kind = body.get('kind')
+                count = integer(body.get('count'), 'count')
+                if kind not in ('sale', 'restock', 'adjustment'):
+                    raise HTTPError(400, 'kind must be sale, restock or adjustment')
+                if kind != 'adjustment' and count <= 0:
+                    raise HTTPError(400, 'count must be positive')
+                delta = -count if kind == 'sale' else count
+                work = lambda repo: repo.adjust_stock(book_id, delta, kind, body.get('note'))
+            try:
+                qty = await self.database(work)
+            except StockError as error:
+                raise HTTPError(409, str(error))
+            return 200, {'id': book_id, 'Qty': qty}
+        if len(parts) == 2 and parts[0] == 'books':
+            book_id = integer(parts[1], 'id')
+            if method == 'GET':
+                book = await self.database(lambda repo: repo.get_by_id(book_id))
+                if book is None:
+                    raise HTTPError(404, 'book not found')
+                return 200, book_json(book)
+            if method == 'PATCH':
+                title, author, qty = book_fields(body, False)
+                def update(repo):
+                    if repo.update(book_id, title, author, qty):
+                        return repo.get_by_id(book_id)
+                    return None
+                book = await self.database(update, write=True)
+                if book is None:
+                    raise HTTPError(404, 'book not found')
+                return 200, book_json(book)
+            if method == 'DELETE':
+                if not await self.database(lambda repo: repo.delete(book_id), write=True):
+                    raise HTTPError(404, 'book not found')
+                return 200, {'deleted': book_id}
+            raise HTTPError(405, 'use GET, PATCH or DELETE')
+        if parts == ['search'] and method == 'GET':
+            limit = bounded(query.get('limit', [50])[0], 'limit')
+            if any(name in query for name in COMPOSITE_FILTERS):
+                bounds = {name: integer(query[name][0], name) if name in query else None
+                    for name in ('min_id', 'max_id', 'min_qty', 'max_qty')}
+                title = query.get('title', [None])[0]
+                author = query.get('author', [None])[0]
+                order = query.get('order', [None])[0]
+                descending = query.get('desc', ['0'])[0] not in ('0', 'false', '')
+                try:
+                    books = await self.database(lambda repo: repo.composite_search(title, author,
+                        (bounds['min_id'], bounds['max_id']), (bounds['min_qty'], bounds['max_qty']), order, descending, limit))
+                except ValueError as error:
+                    raise HTTPError(400, str(error))
+            elif 'qty' in query:
+                qty = integer(query['qty'][0], 'qty')
+                books = await self.database(lambda repo: repo.find_by_qty(qty))
+                books = books[:limit]
+            else:
+                text = query.get('q', [''])[0]
+                field = query.get('field', [None])[0]
+                columns = {None: None, 'title': 'Title', 'author': 'Author'}
+                if field not in columns:
+                    raise HTTPError(400, 'field must be title or author')
+                books = await self.database(lambda repo: repo.search(text, columns[field], limit))
+            return 200, {'books': [book_json(book) for book in books]}
+        if len(parts) == 2 and parts[0] == 'reports' and method == 'GET':
+            limit = bounded(query.get('limit', [MAX_LIMIT])[0], 'limit')
+            if parts[1] == 'low-stock':
+                below = integer(query.get('below', [None])[0], 'below')
+                count, books = await self.database(lambda repo: (repo.low_stock_count(below), repo.low_stock(below, limit)))
+                return 200, {'count': count, 'books': [book_json(book) for book in books]}
+            if parts[1] in ('top', 'bottom'):
+                count = bounded(query.get('n', [10])[0], 'n')
+                if parts[1] == 'top':
+                    books = await self.database(lambda repo: repo.top_by_qty(count))
+                else:
+                    books = await self.database(lambda repo: repo.bottom_by_qty(count))
+                return 200, {'books': [book_json(book) for book in books]}
+            if parts[1] == 'authors':
+                author = query.get('author', [None])[0]
+                totals = await self.database(lambda repo: repo.author_totals(author, limit))
+                return 200, {'authors': [total._asdict() for total in totals]}
+        if parts == ['changes'] and method == 'GET':
+            since = integer(query.get('since', [0])[0], 'since')
+            limit = bounded(query.get('limit', [CHANGE_LIMIT])[0], 'limit', CHANGE_LIMIT)
+            try:
+                changes, latest = await self.database(lambda repo: (changes_since(repo.db, since, limit), latest_change(repo.db)))
+            except ChangeLogError as error:
+                raise HTTPError(410, str(error))
+            #the mirror has to read every book again, as the changes it missed are gone
+            return 200, {'changes': [change._asdict() for change in changes], 'latest': latest}
+        if parts == ['changes', 'ack'] and method == 'POST':
+            if not isinstance(body, dict) or not isinstance(body.get('consumer'), str):
+                raise HTTPError(400, 'send {"consumer": name, "seq": number}')
+            seq = integer(body.get('seq'), 'seq')
+            await self.database(lambda repo: acknowledge(repo.db, body['consumer'], seq), write=True)
+            return 200, {'consumer': body['consumer'], 'seq': seq}
+        if parts == ['stats', 'cache'] and method == 'GET':
+            return 200, self.cache.stats()
+        if parts in (['books'], ['search'], ['books', 'lookup'], ['books', 'delete'], ['changes'], ['changes', 'ack']):
+            raise HTTPError(405, 'method not allowed')
+        raise HTTPError(404, 'no such route')
+
+    async def handle(self, reader, writer):
+        '''This function reads requests from one client connection and answers them in turn.
+        The connection is kept open for more requests unless the client asks to close it'''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if request_line == b'':
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, {'error': 'bad request line'}, False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                status, result = await self.answer(reader, method.upper(), target, headers)
+                await self.respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, reader, method, target, headers):
+        try:
+            length = integer(headers.get('content-length', 0), 'Content-Length')
+            if length > MAX_BODY:
+                raise HTTPError(413, 'request body too large')
+            body = None
+            if length > 0:
+                raw = await reader.readexactly(length)
+                try:
+                    body = json.loads(raw)
+                except ValueError:
+                    raise HTTPError(400, 'the body must be JSON')
+            url = urlsplit(target)
+            return await self.route(method, url.path, parse_qs(url.query), body)
+        except HTTPError as error:
+            return error.status, {'error': error.message}
+        except sqlite3.IntegrityError as error:
+            return 409, {'error': f'this conflicts with a book already in the database: {error}'}
+        except sqlite3.Error as error:
+            return 500, {'error': f'database error: {error}'}
+
+    async def respond(self, writer, status, result, keep_alive):
+        payload = json.dumps(result).encode('utf-8')
+        head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+
+async def start_service(host=DEFAULT_HOST, port=DEFAULT_PORT, path=DATABASE_PATH, workers=WORKERS, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
+    '''This function starts listening and returns the asyncio server and the service, so a
+    test or another program can run a local instance on port 0 and stop it afterwards'''
+    service = BookService(path, workers, cache_size, cache_ttl)
+    server = await asyncio.start_server(service.handle, host, port)
+    return server, service
+
+async def serve(host, port, path, workers, cache_size, cache_ttl):
+    server, service = await start_service(host, port, path, workers, cache_size, cache_ttl)
+    address = server.sockets[0].getsockname()
+    print(f"Serving the bookstore database on http://{address[0]}:{address[1]}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Serve the bookstore database over HTTP/JSON.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--database', default=DATABASE_PATH, help='the database file to serve')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='threads running SQLite calls')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help='lookups kept in the memory cache')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL, help='seconds a cached lookup is trusted for')
+    parser.add_argument('--maintenance-every', type=float, metavar='SECONDS',
+        help='vacuum, analyze and checkpoint the database this often while serving')
+    parser.add_argument('--backup', metavar='PATH', help='back up to this file at each maintenance run, it can contain strftime codes')
+    options = parser.parse_args(arguments)
+    scheduler = None
+    if options.maintenance_every is not None:
+        scheduler = MaintenanceScheduler(options.database, options.maintenance_every, backup_path=options.backup).start()
+        #maintenance runs on its own thread and connection so requests are never held up by it
+    try:
+        asyncio.run(serve(options.host, options.port, options.database, options.workers, options.cache_size, options.cache_ttl))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if scheduler is not None:
+            scheduler.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''This module moves books in and out of the database in bulk.
+A supplier catalog in a CSV or JSONL file can be imported without typing each book in, and
+the books table can be exported to the same formats. Both directions stream the file and the
+table in chunks so even a very large catalog never has to fit in memory at once.
+'''
+#====Module Section====#
+import csv
+import json
+import os
+from collections import namedtuple
+
+from bookstore_repository import insert_books
+from bookstore_search import title_key
+
+CHUNK_SIZE = 1000
+#This is the number of rows written in each transaction, or read at once when exporting
+FIELDS = ['id', 'Title', 'Author', 'Qty']
+#These are the columns of the file, id is optional when importing
+
+ImportResult = namedtuple('ImportResult', ['inserted', 'rejects'])
+#rejects is a list of (line number, reason) for every row that was not imported
+
+
+#====Function Section====#
+def file_format(path):
+    #The format of the file is worked out from its extension
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    raise ValueError(f"Unsupported file type '{extension}', please use a .csv or .jsonl file")
+
+def read_records(path):
+    '''This generator reads the file one row at a time and yields the line number with a
+    dictionary of the values. Lines that are not valid JSON are yielded with None so that
+    they can be reported as rejects rather than stopping the import'''
+    with open(path, newline='', encoding='utf-8') as book_file:
+        if file_format(path) == 'csv':
+            reader = csv.DictReader(book_file)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(book_file, 1):
+                if line.strip() == '':
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if not isinstance(record, dict):
+                    record = None
+                yield line_number, record
+
+def whole_number(value):
+    '''This reads a whole number from a file value, which must be an int or text holding one.
+    JSON true and 2.9 would quietly become 1 and 2 through int(), so they raise ValueError'''
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'{value!r} is not a whole number')
+    return int(value)
+
+def check_record(record):
+    '''This function checks a row from the file against the rules of the books table.
+    It returns the book as an (id, Title, Author, Qty) tuple and None, or None and the
+    reason the row was rejected'''
+    if record is None:
+        return None, 'not a valid record'
+    #column names are matched without caring about case so 'title' and 'Title' both work
+    values = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+    title = str(values.get('title') or '').strip()
+    author = str(values.get('author') or '').strip()
+    if title == '':
+        return None, 'missing Title'
+    if author == '':
+        return None, 'missing Author'
+    try:
+        qty = whole_number(values.get('qty'))
+    except (TypeError, ValueError):
+        return None, 'invalid Qty'
+    if qty < 0:
+        return None, 'invalid Qty'
+    book_id = values.get('id')
+    if book_id in (None, ''):
+        book_id = None
+    else:
+        try:
+            book_id = whole_number(book_id)
+        except (TypeError, ValueError):
+            return None, 'invalid id'
+    return (book_id, title, author, qty), None
+
+def insert_chunk(db, chunk, rejects):
+    '''This function inserts one chunk of checked books in a single transaction.
+    Titles and ids already in the table are found with one indexed query for the whole chunk,
+    those rows and any repeated inside the chunk are rejected and the rest are inserted with
+    executemany. Titles are compared by their title key, so a title that only differs in case
+    or punctuation is still a duplicate. Rows with an id are inserted before rows without
+    one, so an id SQLite picks can never take an id asked for later in the chunk. It returns
+    the number of books inserted'''
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        titles = json.dumps([title_key(book[1]) for line_number, book in chunk])
+        ids = json.dumps([book[0] for line_number, book in chunk if book[0] is not None])
+        taken_titles = {row[0] for row in db.execute('''
+        SELECT title_key FROM books WHERE title_key IN (SELECT value FROM json_each(?))
+        ''', (titles,))}
+        taken_ids = {row[0] for row in db.execute('''
+        SELECT id FROM books WHERE id IN (SELECT value FROM json_each(?))
+        ''', (ids,))}
+        new_books = []
+        for line_number, book in chunk:
+            if title_key(book[1]) in taken_titles:
+                rejects.append((line_number, 'duplicate title'))
+            elif book[0] is not None and book[0] in taken_ids:
+                rejects.append((line_number, 'duplicate id'))
+            else:
+                taken_titles.add(title_key(book[1]))
+                taken_ids.add(book[0])
+                new_books.append(book)
+        insert_books(db, [book for book in new_books if book[0] is not None])
+        insert_books(db, [book for book in new_books if book[0] is None])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(new_books)
+
+def import_file(db, path, chunk_size=CHUNK_SIZE):
+    '''This function imports every valid book in a CSV or JSONL file. Rows are committed
+    chunk_size at a time, so a bad row only costs that row and never the whole import'''
+    file_format(path)
+    #this checks the extension before anything is read
+    inserted = 0
+    rejects = []
+    chunk = []
+    for line_number, record in read_records(path):
+        book, reason = check_record(record)
+        if book is None:
+            rejects.append((line_number, reason))
+            continue
+        chunk.append((line_number, book))
+        if len(chunk) >= chunk_size:
+            inserted += insert_chunk(db, chunk, rejects)
+            chunk = []
+    if chunk != []:
+        inserted += insert_chunk(db, chunk, rejects)
+    rejects.sort()
+    #duplicates are found a chunk later than bad values so the rejects are put back in file order
+    return ImportResult(inserted, rejects)
+
+def export_file(db, path, chunk_size=CHUNK_SIZE):
+    '''This function writes the books table to a CSV or JSONL file in id order. Rows are
+    taken from the cursor chunk_size at a time with fetchmany and written straight out.
+    It returns the number of books written'''
+    output_format = file_format(path)
+    cursor = db.execute('''
+    SELECT id, Title, Author, Qty FROM book_details ORDER BY id
+    ''')
+    written = 0
+    with open(path, 'w', newline='', encoding='utf-8') as book_file:
+        if output_format == 'csv':
+            writer = csv.writer(book_file)
+            writer.writerow(FIELDS)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if rows == []:
+                break
+            if output_format == 'csv':
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    book_file.write(json.dumps(dict(zip(FIELDS, row))) + '\n')
+            written += len(rows)
+    return written
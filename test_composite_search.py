@@ -0,0 +1,58 @@
+'''These tests check that every common composite search in PLAN_CHECKS is answered through an
+index, on a seeded catalog both before and after ANALYZE, and that its results match the
+filters. Run them with python -m pytest.
+'''
+#====Module Section====#
+import pytest
+
+from bookstore_benchmark import PLAN_CHECKS, build_catalog, full_scans
+
+CATALOG_SIZE = 5000
+#big enough that the planner has a reason to prefer an index
+
+
+#====Fixture Section====#
+@pytest.fixture(scope='module', params=[False, True], ids=['new', 'analyzed'])
+def repo(request, tmp_path_factory):
+    #A new shop has no planner statistics yet, so each check runs without and with them
+    books = build_catalog(str(tmp_path_factory.mktemp('catalog') / 'catalog.db'), CATALOG_SIZE)
+    if request.param:
+        books.db.execute('ANALYZE')
+        books.db.commit()
+    yield books
+    books.close()
+
+
+#====Test Section====#
+@pytest.mark.parametrize('filters', PLAN_CHECKS, ids=str)
+def test_plan_never_scans_books(repo, filters):
+    plan = repo.composite_plan(**filters)
+    assert full_scans(plan, limited=True) == [], plan
+    #every composite search has a LIMIT, so a walk along the index of its order stops early
+
+@pytest.mark.parametrize('filters', PLAN_CHECKS, ids=str)
+def test_results_match_filters(repo, filters):
+    low_id, high_id = filters.get('id_range', (None, None))
+    low_qty, high_qty = filters.get('qty_range', (None, None))
+    books = repo.composite_search(**filters)
+    for book in books:
+        assert low_id is None or book.id >= low_id
+        assert high_id is None or book.id <= high_id
+        assert low_qty is None or book.Qty >= low_qty
+        assert high_qty is None or book.Qty <= high_qty
+        for word in filters.get('title', '').split():
+            assert word in book.Title.lower()
+        for word in filters.get('author', '').split():
+            assert word in book.Author.lower()
+
+def test_full_scans_include_index_walks():
+    assert full_scans(['SCAN books']) == ['SCAN books']
+    assert full_scans(['SCAN books USING INDEX idx_books_title_key']) != []
+    assert full_scans(['SCAN books USING INDEX idx_books_title_key'], limited=True) == []
+    assert full_scans(['SCAN books USING INDEX idx_books_qty', 'USE TEMP B-TREE FOR ORDER BY'], limited=True) != []
+    assert full_scans(['SCAN books_fts VIRTUAL TABLE INDEX 0:']) != []
+    assert full_scans(['SCAN books_fts VIRTUAL TABLE INDEX 32:M2', 'SEARCH books USING INTEGER PRIMARY KEY (rowid=?)']) == []
+
+def test_relevance_needs_words(repo):
+    with pytest.raises(ValueError):
+        repo.composite_search(qty_range=(0, 5), order='relevance')